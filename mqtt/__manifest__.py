@@ -5,7 +5,7 @@
     "name": "MQTT Framework",
     "summary": "MQTT Client and Framework",
     "license": "AGPL-3",
-    "version": "15.0.1.0.0",
+    "version": "15.0.1.2.0",
     "website": "https://github.com/OCA/...",
     "author": "initOS GmbH",
     "depends": ["base_setup"],
@@ -19,6 +19,7 @@
         "views/mqtt_event_views.xml",
         "views/mqtt_message_views.xml",
         "views/mqtt_subscription_views.xml",
+        "views/mqtt_topic_views.xml",
         "views/res_config_settings_views.xml",
     ],
     "demo": [
@@ -0,0 +1,82 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import json
+
+from odoo import _
+from odoo.exceptions import UserError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Formats of the payloads. The binary formats require optional libraries
+PAYLOAD_FORMATS = [
+    ("json", "JSON"),
+    ("msgpack", "MessagePack"),
+    ("cbor", "CBOR"),
+]
+
+
+def _get_library(payload_format):
+    library = {"msgpack": msgpack, "cbor": cbor2}.get(payload_format)
+    if library is None:
+        raise UserError(_("The payload format %s is not available") % payload_format)
+    return library
+
+
+def encode_payload(data, payload_format="json", encoder=json.JSONEncoder):
+    """Encode the data in the format. JSON produces a string and the binary
+    formats bytes. Unsupported values are converted by the JSON encoder"""
+    if payload_format == "json":
+        return json.dumps(data, cls=encoder)
+
+    library = _get_library(payload_format)
+    default = encoder().default
+    if library is cbor2:
+        return cbor2.dumps(data, default=lambda enc, value: enc.encode(default(value)))
+    return msgpack.packb(data, default=default, use_bin_type=True)
+
+
+def decode_payload(payload, payload_format="json"):
+    """Decode a payload which was encoded in the format"""
+    if payload_format == "json":
+        return json.loads(payload)
+
+    if isinstance(payload, str):
+        raise UserError(_("Binary payload expected"))
+
+    library = _get_library(payload_format)
+    if library is cbor2:
+        return cbor2.loads(payload)
+    return msgpack.unpackb(payload, raw=False)
+
+
+def array_start(payload_format, size):
+    """Returns the start of an encoded array with the given number of items.
+    Together with the encoded items and `array_end` it forms the same payload
+    as encoding the whole list at once"""
+    if payload_format == "json":
+        return "["
+
+    if _get_library(payload_format) is msgpack:
+        return msgpack.Packer().pack_array_header(size)
+
+    # Header of a CBOR array (major type 4) with the length as argument
+    if size < 24:
+        return bytes([0x80 | size])
+    for info, length in ((24, 1), (25, 2), (26, 4), (27, 8)):
+        if size < 256**length:
+            return bytes([0x80 | info]) + size.to_bytes(length, "big")
+    raise ValueError("Array too large")
+
+
+def array_end(payload_format):
+    """Returns the end of an encoded array"""
+    return "]" if payload_format == "json" else b""
@@ -0,0 +1,34 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo.tools import column_exists
+
+
+def migrate(cr, version):
+    """Move the payloads from the text column into the binary column. Payloads
+    which were encoded with base64 are stored as raw bytes"""
+    cr.execute(
+        """
+        UPDATE mqtt_message SET payload_encoding = 'binary'
+        WHERE payload_encoding = 'base64'
+        """
+    )
+
+    if not column_exists(cr, "mqtt_message", "payload"):
+        return
+
+    cr.execute(
+        """
+        UPDATE mqtt_message
+        SET payload_data = CASE WHEN payload_encoding = 'binary'
+                THEN decode(payload, 'base64') ELSE convert_to(payload, 'UTF8') END,
+            payload_codec = 'none'
+        WHERE payload IS NOT NULL AND payload != ''
+        """
+    )
+    cr.execute(
+        """
+        UPDATE mqtt_message SET payload_size = COALESCE(octet_length(payload_data), 0)
+        """
+    )
+    cr.execute("ALTER TABLE mqtt_message DROP COLUMN payload")
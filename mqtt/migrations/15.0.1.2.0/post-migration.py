@@ -0,0 +1,44 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import SUPERUSER_ID, api
+from odoo.tools import column_exists
+
+
+def migrate(cr, version):
+    """Move the topics of the messages into the topic table and reference them
+    from the messages"""
+    if not column_exists(cr, "mqtt_message", "topic"):
+        return
+
+    cr.execute(
+        """
+        INSERT INTO mqtt_topic (
+            topic, depth, root, first_seen, last_seen, incoming_count, outgoing_count
+        )
+        SELECT topic, array_length(string_to_array(topic, '/'), 1),
+            split_part(topic, '/', 1), MIN(create_date), MAX(create_date),
+            COUNT(*) FILTER (WHERE direction = 'incoming'),
+            COUNT(*) FILTER (WHERE direction = 'outgoing')
+        FROM mqtt_message
+        WHERE topic IS NOT NULL AND topic != ''
+        GROUP BY topic
+        ON CONFLICT (topic) DO NOTHING
+        """
+    )
+    cr.execute(
+        """
+        UPDATE mqtt_message m SET topic_id = t.id
+        FROM mqtt_topic t WHERE t.topic = m.topic
+        """
+    )
+    cr.execute("ALTER TABLE mqtt_message DROP COLUMN topic")
+
+    # The existing messages are already part of the statistics
+    cr.execute("SELECT MAX(create_date) FROM mqtt_message")
+    last_date = cr.fetchone()[0]
+    if last_date:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        env["ir.config_parameter"].set_param(
+            "mqtt.topic_statistics_date", last_date.isoformat(" ")
+        )
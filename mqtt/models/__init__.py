@@ -5,9 +5,11 @@ from . import (
     base,
     ir_config_parameter,
     mqtt_base,
+    mqtt_delivery,
     mqtt_event,
     mqtt_message,
     mqtt_processor,
     mqtt_subscription,
+    mqtt_topic,
     res_config_settings,
 )
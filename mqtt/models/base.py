@@ -2,10 +2,14 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import json
+from collections import defaultdict
 from datetime import date, datetime
 
 from odoo import api, fields, models
 
+from ..formats import encode_payload
+from ..topic import render_topic
+
 
 class Encoder(json.JSONEncoder):
     def default(self, o):
@@ -33,49 +37,198 @@ class Base(models.AbstractModel):
         retain=False,
         enqueue=True,
         skip_empty_payload=False,
+        payload_format="json",
     ):
-        """Helper function to publish a new message"""
-        if skip_empty_payload and not payload:
+        """Helper function to publish a new message. Payloads which aren't strings
+        or bytes are encoded in the payload format"""
+        vals = self._mqtt_prepare_message(
+            topic, payload, qos, retain, enqueue, skip_empty_payload, payload_format
+        )
+        if not vals:
             return self.env["mqtt.message"].browse()
+        return self.env["mqtt.message"].create(vals)
 
-        if not isinstance(payload, str):
-            payload = json.dumps(payload, cls=Encoder)
+    @api.model
+    def _mqtt_prepare_message(
+        self,
+        topic,
+        payload,
+        qos="0",
+        retain=False,
+        enqueue=True,
+        skip_empty_payload=False,
+        payload_format="json",
+    ):
+        if skip_empty_payload and not payload:
+            return None
+
+        if not isinstance(payload, (bytes, str)):
+            payload = encode_payload(payload, payload_format, encoder=Encoder)
 
-        return self.env["mqtt.message"].create(
+        # The payload is stored as raw bytes and compressed if it is large
+        vals = self.env["mqtt.message"]._prepare_payload_vals(payload)
+        vals.update(
             {
                 "direction": "outgoing",
                 "state": "enqueued" if enqueue else "draft",
                 "enqueue_date": datetime.now(),
                 "topic": topic,
-                "payload": payload,
                 "qos": qos,
                 "retain": retain,
             }
         )
+        return vals
+
+    @api.model
+    def _mqtt_events(self, xmlid):
+        """Returns the cached event descriptors of the model for the event type"""
+        type_id = self.env["ir.model.data"]._xmlid_to_res_id(
+            xmlid, raise_if_not_found=False
+        )
+        if not type_id:
+            return ()
+        return self.env["mqtt.event"]._get_event_descriptors(self._name, type_id)
+
+    def _mqtt_group_by_topic(self, descriptor):
+        """Group the records by the topic of the event. Record placeholders are
+        filled with the field values and relations are replaced by their IDs"""
+        if not descriptor.topic_fields:
+            return {descriptor.topic: self}
+
+        groups = defaultdict(list)
+        for rec in self:
+            values = {}
+            for fname in descriptor.topic_fields:
+                value = rec[fname]
+                if isinstance(value, models.BaseModel):
+                    value = ",".join(map(str, value.ids))
+                values[fname] = "" if value is False else value
+            groups[render_topic(descriptor.topic, values)].append(rec.id)
+        return {topic: self.browse(ids) for topic, ids in groups.items()}
+
+    def _mqtt_event_messages(self, descriptor, fields):
+        """Returns the values of the messages of the event for the records"""
+        event = self.env["mqtt.event"].sudo().browse(descriptor.event_id)
+        size = descriptor.split
+        # Generate the payloads of all records at once if they are split
+        payloads = event.to_payloads(self, fields) if size else None
+
+        vals_list = []
+        for topic, records in self._mqtt_group_by_topic(descriptor).items():
+            if not size:
+                chunks = [event.to_payload(records, fields)]
+            elif payloads is None:
+                chunks = [
+                    event.to_payload(records[i : i + size], fields)
+                    for i in range(0, len(records), size)
+                ]
+            else:
+                items = [payloads[i] for i in records.ids if i in payloads]
+                chunks = [items[i : i + size] for i in range(0, len(items), size)]
+                if size == 1:
+                    chunks = [chunk[0] for chunk in chunks]
+
+            for payload in chunks:
+                vals = self._mqtt_prepare_message(
+                    topic,
+                    payload,
+                    qos=descriptor.qos,
+                    retain=descriptor.retain,
+                    skip_empty_payload=True,
+                    payload_format=descriptor.payload_format,
+                )
+                if vals:
+                    vals_list.append(vals)
+        return vals_list
+
+    def _mqtt_pending_events(self):
+        """Events are collected during the transaction and published right
+        before the commit"""
+        data = self.env.cr.precommit.data
+        if "mqtt.events" not in data:
+            data["mqtt.events"] = {
+                # Records created within the transaction
+                "created": defaultdict(set),
+                # Changed fields per (model, event descriptor, env) and record
+                "events": {},
+                # Arguments of the environments which changed the records. The
+                # payloads are generated with them as the user would have
+                "envs": [],
+                # Events in order of occurrence. Either the key of an event or
+                # the values of a prepared message
+                "queue": [],
+            }
+            self.env.cr.precommit.add(self.env["base"].sudo()._mqtt_flush_events)
+        return data["mqtt.events"]
+
+    def _mqtt_env_index(self, pending):
+        """Returns the index of the current environment in the pending events"""
+        args = (self.env.uid, self.env.context, self.env.su)
+        if args not in pending["envs"]:
+            pending["envs"].append(args)
+        return pending["envs"].index(args)
+
+    def _mqtt_collect_event(self, descriptor, fields):
+        pending = self._mqtt_pending_events()
+        key = (self._name, descriptor, self._mqtt_env_index(pending))
+        if key not in pending["events"]:
+            pending["events"][key] = {}
+            pending["queue"].append(key)
+
+        changes = pending["events"][key]
+        for rec_id in self.ids:
+            changes.setdefault(rec_id, set()).update(fields)
+
+    @api.model
+    def _mqtt_flush_events(self):
+        """Serialize the collected events and create all messages at once. The
+        payloads contain the final values of the records and are generated in
+        the environment of the user who changed them. Filters of the events are
+        evaluated against the final values as well"""
+        pending = self.env.cr.precommit.data.pop("mqtt.events", None)
+        if not pending:
+            return
+
+        vals_list = []
+        for item in pending["queue"]:
+            if isinstance(item, dict):
+                vals_list.append(item)
+                continue
+
+            model_name, descriptor, env_index = item
+            uid, context, su = pending["envs"][env_index]
+            env = api.Environment(self.env.cr, uid, context, su=su)
+            by_fields = defaultdict(list)
+            for rec_id, fnames in pending["events"][item].items():
+                by_fields[frozenset(fnames)].append(rec_id)
+
+            for fnames, ids in by_fields.items():
+                records = env[model_name].browse(ids).exists()
+                if records:
+                    vals_list.extend(
+                        records._mqtt_event_messages(descriptor, set(fnames))
+                    )
+
+        if vals_list:
+            self.env["mqtt.message"].sudo().create(vals_list).flush()
 
     @api.model_create_multi
     @api.returns("self", lambda value: value.id)
     def create(self, vals_list):
         records = super().create(vals_list)
-        if self.mqtt_blacklisted():
+        if not records or self.mqtt_blacklisted():
             return records
 
-        # Generate messages for defined events
-        etype = self.sudo().env.ref("mqtt.type_create", False)
-        if not etype or not records:
-            return records
+        # Collect the messages for defined events
+        descriptors = self._mqtt_events("mqtt.type_create")
+        if descriptors:
+            pending = self._mqtt_pending_events()
+            pending["created"][self._name].update(records.ids)
 
-        domain = [("model", "=", self._name), ("type_ids", "=", etype.id)]
-        for event in self.env["mqtt.event"].sudo().search(domain):
-            fields = set(event.mapped("field_ids.name"))
+        for descriptor in descriptors:
+            fields = set(descriptor.fields)
             fields.update(["create_date", "create_uid"])
-            self.sudo().mqtt_publish(
-                event.convert_topic(etype),
-                payload=event.to_payload(records, fields),
-                qos=event.qos,
-                retain=event.retain,
-                skip_empty_payload=True,
-            )
+            records._mqtt_collect_event(descriptor, fields)
 
         return records
 
@@ -84,47 +237,56 @@ class Base(models.AbstractModel):
         if self.mqtt_blacklisted():
             return res
 
-        # Generate messages for defined events
-        etype = self.sudo().env.ref("mqtt.type_write", False)
-        if not etype:
+        descriptors = self._mqtt_events("mqtt.type_write")
+        if not descriptors:
             return res
 
-        domain = [("model", "=", self._name), ("type_ids", "=", etype.id)]
-        for event in self.env["mqtt.event"].sudo().search(domain):
-            fields = set(event.mapped("field_ids.name"))
-            if event.changes_only:
+        # Records created in the same transaction are published with the final
+        # values by the create event
+        pending = self._mqtt_pending_events()
+        records = self.browse(set(self.ids) - pending["created"][self._name])
+
+        # Collect the messages for defined events
+        for descriptor in descriptors:
+            fields = set(descriptor.fields)
+            if descriptor.changes_only:
                 fields = fields.intersection(vals)
 
             if fields:
                 fields.update(("write_date", "write_uid"))
-                self.sudo().mqtt_publish(
-                    event.convert_topic(etype),
-                    payload=event.to_payload(self, fields),
-                    qos=event.qos,
-                    retain=event.retain,
-                    skip_empty_payload=True,
-                )
+                records._mqtt_collect_event(descriptor, fields)
 
         return res
 
+    def _mqtt_discard_events(self):
+        """Remove the collected events of deleted records"""
+        pending = self.env.cr.precommit.data.get("mqtt.events")
+        if not pending:
+            return
+
+        for (model_name, *_rest), changes in pending["events"].items():
+            if model_name == self._name:
+                for rec_id in self.ids:
+                    changes.pop(rec_id, None)
+
     def unlink(self):
         if self.mqtt_blacklisted():
             return super().unlink()
 
-        # Generate messages for defined events
-        etype = self.sudo().env.ref("mqtt.type_delete", False)
-        if not etype:
-            return super().unlink()
+        self._mqtt_discard_events()
+
+        descriptors = self._mqtt_events("mqtt.type_delete")
+        if descriptors:
+            # Records created within the transaction were never published
+            pending = self._mqtt_pending_events()
+            records = self.browse(set(self.ids) - pending["created"][self._name])
+        else:
+            records = self.browse()
 
-        domain = [("model", "=", self._name), ("type_ids", "=", etype.id)]
-        for event in self.env["mqtt.event"].sudo().search(domain):
-            fields = set(event.mapped("field_ids.name"))
-            self.sudo().mqtt_publish(
-                event.convert_topic(etype),
-                payload=event.to_payload(self, fields),
-                qos=event.qos,
-                retain=event.retain,
-                skip_empty_payload=True,
+        # The payload must be generated before the records are deleted
+        for descriptor in descriptors if records else ():
+            pending["queue"].extend(
+                records._mqtt_event_messages(descriptor, set(descriptor.fields))
             )
 
         return super().unlink()
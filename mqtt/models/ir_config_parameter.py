@@ -3,7 +3,7 @@
 
 import uuid
 
-from odoo import models
+from odoo import api, models
 
 
 class IrConfigParameter(models.Model):
@@ -17,3 +17,9 @@ class IrConfigParameter(models.Model):
             params.set_param("mqtt.uuid", str(uuid.uuid4()))
 
         return res
+
+    @api.model
+    def _get_mqtt_client_id(self):
+        """Returns the ID of the MQTT client. The parameter is read from the
+        cache of `get_param`"""
+        return self.sudo().get_param("mqtt.uuid") or None
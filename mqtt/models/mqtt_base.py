@@ -2,8 +2,15 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import inspect
+from collections import namedtuple
 
-from odoo import _, fields, models
+from odoo import _, fields, models, tools
+
+# Channel used to wake up the MQTT runner if new work is available
+NOTIFY_CHANNEL = "mqtt_runner"
+
+# Function decorated with `api.mqtt`
+Handler = namedtuple("Handler", ["model", "method", "topic"])
 
 
 def is_mqtt(func):
@@ -26,7 +33,23 @@ class MQTTBase(models.AbstractModel):
     topic = fields.Char(required=True)
     qos = fields.Selection("_get_qos", "Quality of Service", default="0", required=True)
 
+    @tools.ormcache()
+    def _get_mqtt_handlers(self):
+        """Collect the decorated functions of all models. The result is cached
+        until the registry is reloaded. The runner applies the reloads of the
+        other workers with `check_signaling` before it routes messages"""
+        return tuple(
+            Handler(name, attr, func._mqtt)
+            for name, model_class in self.pool.items()
+            for attr, func in inspect.getmembers(model_class, is_mqtt)
+        )
+
     def _mqtt_functions(self):
-        for model in self.env.values():
-            for attr, func in inspect.getmembers(type(model), is_mqtt):
-                yield model, attr, func
+        for handler in self._get_mqtt_handlers():
+            model = self.env[handler.model]
+            yield model, handler.method, getattr(type(model), handler.method)
+
+    def _notify_runner(self, payload):
+        """Notify the MQTT runner about new work. The notification is only
+        delivered if the transaction is committed"""
+        self.env.cr.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, payload))
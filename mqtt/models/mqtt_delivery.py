@@ -0,0 +1,122 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from collections import defaultdict
+
+from psycopg2.extras import execute_values
+
+from odoo import _, api, fields, models
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 60
+
+
+class MQTTDelivery(models.Model):
+    _name = "mqtt.delivery"
+    _description = _("MQTT Message Delivery")
+    _order = "id"
+    _log_access = False
+
+    def _get_states(self):
+        return [
+            ("done", _("Done")),
+            ("failed", _("Failed")),
+            ("dead", _("Dead")),
+        ]
+
+    message_id = fields.Many2one(
+        "mqtt.message",
+        ondelete="cascade",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    subscriber = fields.Char(required=True, readonly=True)
+    state = fields.Selection("_get_states", required=True, readonly=True)
+    attempts = fields.Integer(default=0, readonly=True)
+    next_attempt = fields.Datetime(readonly=True)
+    error = fields.Text(readonly=True)
+
+    _sql_constraints = [
+        (
+            "delivery_uniq",
+            "UNIQUE(message_id, subscriber)",
+            _("A message can only be delivered once to a subscriber"),
+        )
+    ]
+
+    @api.model
+    def _get_retry_config(self):
+        """Returns the base delay in seconds and the maximum number of attempts"""
+        param = self.env["ir.config_parameter"].sudo().get_param
+        try:
+            delay = int(param("mqtt.router_retry_delay", DEFAULT_RETRY_DELAY))
+        except ValueError:
+            delay = DEFAULT_RETRY_DELAY
+
+        try:
+            attempts = int(param("mqtt.router_max_attempts", DEFAULT_MAX_ATTEMPTS))
+        except ValueError:
+            attempts = DEFAULT_MAX_ATTEMPTS
+
+        return max(delay, 0), max(attempts, 1)
+
+    @api.model
+    def _register(self, messages, subscriber, state, error=None):
+        """Store the result of the delivery to a subscriber in one statement.
+        Failed deliveries are retried with an exponential backoff until the
+        maximum number of attempts is reached"""
+        if not messages:
+            return
+
+        messages.flush()
+        cr = self.env.cr
+        rows = [(msg_id, subscriber.key, state, error) for msg_id in messages.ids]
+        execute_values(
+            cr._obj,
+            """
+            INSERT INTO mqtt_delivery (message_id, subscriber, state, error, attempts)
+            VALUES %s
+            ON CONFLICT (message_id, subscriber) DO UPDATE
+            SET state = EXCLUDED.state, error = EXCLUDED.error, next_attempt = NULL,
+                attempts = mqtt_delivery.attempts + 1
+            """,
+            rows,
+            template="(%s, %s, %s, %s, 1)",
+            page_size=len(rows),
+        )
+
+        if state == "failed":
+            delay, max_attempts = self._get_retry_config()
+            cr.execute(
+                """
+                UPDATE mqtt_delivery
+                SET state = CASE WHEN attempts >= %s THEN 'dead' ELSE 'failed' END,
+                    next_attempt = (now() at time zone 'UTC')
+                        + make_interval(secs => %s * power(2, LEAST(attempts - 1, 16)))
+                WHERE subscriber = %s AND message_id IN %s
+                """,
+                (max_attempts, delay, subscriber.key, tuple(messages.ids)),
+            )
+
+        self.invalidate_cache()
+
+    @api.model
+    def _get_states_by_message(self, messages):
+        """Returns the state and the time of the next attempt of the deliveries
+        grouped by message and subscriber key"""
+        result = defaultdict(dict)
+        if not messages:
+            return result
+
+        self.flush()
+        self.env.cr.execute(
+            """
+            SELECT message_id, subscriber, state, next_attempt FROM mqtt_delivery
+            WHERE message_id IN %s
+            """,
+            (tuple(messages.ids),),
+        )
+        for msg_id, key, state, next_attempt in self.env.cr.fetchall():
+            result[msg_id][key] = (state, next_attempt)
+        return result
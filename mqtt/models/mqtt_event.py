@@ -2,14 +2,35 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import logging
-from uuid import uuid4
+from collections import namedtuple
 
-from odoo import _, api, fields, models
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import ValidationError
 from odoo.tools import safe_eval
 
+from ..formats import PAYLOAD_FORMATS
+from ..snippet import snippets
+from ..topic import compile_topic
+
 _logger = logging.getLogger(__name__)
 
+# Event definition cached per model and event type. The topic is compiled and
+# `topic_fields` are the names of the record placeholders in it
+EventDescriptor = namedtuple(
+    "EventDescriptor",
+    [
+        "event_id",
+        "fields",
+        "topic",
+        "topic_fields",
+        "qos",
+        "retain",
+        "changes_only",
+        "split",
+        "payload_format",
+    ],
+)
+
 
 class MQTTEventType(models.Model):
     _name = "mqtt.event.type"
@@ -24,6 +45,18 @@ class MQTTEventType(models.Model):
         ("name_uniq", "UNIQUE(name)", _("The type must be unique")),
     ]
 
+    def write(self, vals):
+        res = super().write(vals)
+        # The event descriptors include the code of the type
+        if "code" in vals:
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
     def name_get(self):
         return [
             (rec.id, f"{rec.name} ({rec.code})" if rec.code else rec.name)
@@ -42,6 +75,13 @@ class MQTTEvent(models.Model):
             ("code", _("Code")),
         ]
 
+    def _get_split_modes(self):
+        return [
+            ("none", _("All records")),
+            ("record", _("Per record")),
+            ("chunk", _("In chunks")),
+        ]
+
     def _get_default_code(self):
         variables = self.default_variables()
         desc = "\n".join(f"# - {v}: {desc}" for v, desc in variables.items())
@@ -52,7 +92,8 @@ class MQTTEvent(models.Model):
     topic = fields.Char(
         help="The topic under which messages will get published. Use {code} to "
         "insert the code from the event type. Use {client} to insert the ID of the "
-        "MQTT client",
+        "MQTT client. Other placeholders like {id} or {company_id} are replaced "
+        "with the field values of the records",
     )
     mapping = fields.Selection("_get_mappings", default="simple", required=True)
     model = fields.Char("Model Name", related="model_id.model", store=True, index=True)
@@ -70,6 +111,21 @@ class MQTTEvent(models.Model):
     )
     retain = fields.Boolean(default=False)
     changes_only = fields.Boolean(default=True)
+    split_mode = fields.Selection(
+        "_get_split_modes",
+        default="none",
+        required=True,
+        help="Controls if the records of an event are published in one message, "
+        "in one message per record or in messages with a limited number of records",
+    )
+    chunk_size = fields.Integer(default=100)
+    payload_format = fields.Selection(
+        PAYLOAD_FORMATS,
+        default="json",
+        required=True,
+        help="Encoding of the payload. The binary formats require additional "
+        "python libraries",
+    )
     help_text = fields.Html(compute="_compute_help_text", readonly=True, store=False)
     code = fields.Text(default=lambda self: self._get_default_code())
 
@@ -81,7 +137,7 @@ class MQTTEvent(models.Model):
             lines.append(f"<li>{', '.join(sorted(var))}: {desc}</li>")
 
         desc = "\n".join(lines)
-        self.write({"help_text": f"<ul>{desc}</ul>"})
+        self.help_text = f"<ul>{desc}</ul>"
 
     @api.model
     def default_variables(self):
@@ -99,6 +155,23 @@ class MQTTEvent(models.Model):
         if self.topic and any(k in self.topic for k in "#+"):
             raise ValidationError(_("Topic can't include # or + as character"))
 
+    @api.constrains("model_id", "topic")
+    def _check_topic_fields(self):
+        for rec in self.filtered("topic"):
+            _topic, names = compile_topic(rec.topic, code="", client="")
+            model = self.env[rec.model_id.model]
+            invalid = [name for name in names if name not in model._fields]
+            if invalid:
+                raise ValidationError(
+                    _("Invalid placeholders in the topic: %s") % ", ".join(invalid)
+                )
+
+    @api.constrains("split_mode", "chunk_size")
+    def _check_chunk_size(self):
+        for rec in self:
+            if rec.split_mode == "chunk" and rec.chunk_size < 1:
+                raise ValidationError(_("The chunk size must be positive"))
+
     @api.onchange("model_id")
     def _onchange_model(self):
         if self.model_id:
@@ -108,6 +181,57 @@ class MQTTEvent(models.Model):
                     _("Model is blacklisted and can't be used for an event")
                 )
 
+    def _get_descriptor_fields(self):
+        """Returns the fields which are part of the cached event descriptors"""
+        return {
+            "active",
+            "model_id",
+            "type_ids",
+            "field_ids",
+            "topic",
+            "qos",
+            "retain",
+            "changes_only",
+            "split_mode",
+            "chunk_size",
+            "payload_format",
+        }
+
+    @api.model
+    @tools.ormcache("model_name", "type_id")
+    def _get_event_descriptors(self, model_name, type_id):
+        """Returns the active events of the model for the event type. The result
+        is cached until an event or event type changes"""
+        etype = self.env["mqtt.event.type"].sudo().browse(type_id)
+        client_id = self.env["ir.config_parameter"]._get_mqtt_client_id()
+        domain = [("model", "=", model_name), ("type_ids", "=", type_id)]
+        result = []
+        for event in self.sudo().search(domain):
+            topic, topic_fields = event._compile_topic(etype, client_id)
+            result.append(
+                EventDescriptor(
+                    event.id,
+                    frozenset(event.mapped("field_ids.name")),
+                    topic,
+                    topic_fields,
+                    event.qos,
+                    event.retain,
+                    event.changes_only,
+                    event._get_split_size(),
+                    event.payload_format,
+                )
+            )
+        return tuple(result)
+
+    def _get_split_size(self):
+        """Returns the maximum number of records per message. 0 means unlimited"""
+        self.ensure_one()
+        if self.split_mode == "record":
+            return 1
+        if self.split_mode == "chunk":
+            return max(self.chunk_size, 1)
+        return 0
+
     def _get_eval_context(self):
         self.ensure_one()
         return {
@@ -115,14 +239,18 @@ class MQTTEvent(models.Model):
             "time": safe_eval.time,
         }
 
+    def _compile_topic(self, event_type, client_id):
+        """Resolve the event type and client in the topic. Returns the topic and
+        the names of the remaining record placeholders"""
+        self.ensure_one()
+        return compile_topic(
+            self.topic, code=event_type.code or "", client=client_id or ""
+        )
+
     def convert_topic(self, event_type):
         self.ensure_one()
-        topic = self.topic.replace("{code}", event_type.code)
-        # If no client_id isn't set just generate new onces
-        icp = self.env["ir.config_parameter"].sudo()
-        client_id = icp.get_param("mqtt.uuid", str(uuid4()))
-        topic = topic.replace("{client}", client_id)
-        return topic
+        client_id = self.env["ir.config_parameter"]._get_mqtt_client_id()
+        return self._compile_topic(event_type, client_id)[0]
 
     def _to_payload(self, records, fields=None):
         self.ensure_one()
@@ -130,12 +258,12 @@ class MQTTEvent(models.Model):
         if self.mapping == "code":
             context = self._get_eval_context()
             context.update({"records": records, "fields": fields})
-            safe_eval.safe_eval(self.code, context, mode="exec", nocopy=True)
+            snippets.run(self, "code", context)
             return context.get("result", None)
 
         return records.read(fields)
 
-    def to_payload(self, records, fields=None):
+    def _prepare_payload(self, records, fields=None):
         self.ensure_one()
 
         if self.filter_id:
@@ -145,10 +273,41 @@ class MQTTEvent(models.Model):
             fields = {"id", "create_date", "write_date", "create_uid", "write_uid"}
             fields.update(self.mapped("field_ids.name"))
 
+        return records, fields
+
+    def to_payload(self, records, fields=None):
+        self.ensure_one()
+        records, fields = self._prepare_payload(records, fields)
         return self._to_payload(records, fields=fields)
 
+    def _to_payloads(self, records, fields=None):
+        self.ensure_one()
+
+        if self.mapping == "simple":
+            return {data["id"]: data for data in records.read(fields)}
+
+        # The payload of custom code can't be split by record
+        return None
+
+    def to_payloads(self, records, fields=None):
+        """Generate the payloads of all records at once. Returns a dictionary
+        mapping the record IDs to their payloads or None if the mapping doesn't
+        support it. Records excluded by the filter are missing"""
+        self.ensure_one()
+        records, fields = self._prepare_payload(records, fields)
+        return self._to_payloads(records, fields=fields)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.clear_caches()
+        return records
+
     def write(self, vals):
         res = super().write(vals)
+        if self._get_descriptor_fields().intersection(vals):
+            self.clear_caches()
+
         for rec in self.filtered("active"):
             if not rec.type_ids:
                 raise ValidationError(_("The event must set atleast one type"))
@@ -158,3 +317,8 @@ class MQTTEvent(models.Model):
                 raise ValidationError(_("Topic must be unique"))
 
         return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
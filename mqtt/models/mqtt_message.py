@@ -1,17 +1,65 @@
 # © 2022 Florian Kantelberg - initOS GmbH
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-import json
+import base64
+import binascii
 import logging
-from collections import defaultdict
+import traceback
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-from odoo import _, api, fields, models
+import psycopg2
+
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import AccessDenied, ValidationError
 
+from ..formats import decode_payload
+from ..payload import PAYLOAD_CODECS, get_compression, pack_payload, unpack_payload
+from ..topic import TopicTrie
+from .mqtt_topic import STATISTICS_DELAY
+
 _logger = logging.getLogger(__name__)
 
 DEFAULT_GC_HOURS = 12
+DEFAULT_GC_CHUNK = 10000
+# Key of the advisory lock which prevents concurrent routing
+ROUTER_LOCK = 0x4D515454
+
+
+class RouterLockLost(Exception):
+    """Another router took the lock while the transaction was committed"""
+
+
+class Subscriber(namedtuple("Subscriber", ["kind", "target", "topic"])):
+    """Subscriber of a topic. The target is the tuple of model name and method
+    name for the decorated functions or the ID of the processor"""
+
+    __slots__ = ()
+
+    @property
+    def key(self):
+        """Unique key of the subscriber used for the delivery ledger"""
+        if self.kind == "api":
+            return "api:{}/{}".format(*self.target)
+        return f"{self.kind}:{self.target}"
+
+
+class RawBinary(fields.Binary):
+    """Binary field storing the raw bytes in the column instead of base64. The
+    values are only encoded with base64 if they are read by the client"""
+
+    def convert_to_column(self, value, record, values=None, validate=True):
+        if not value:
+            return None
+        if isinstance(value, str):
+            value = value.encode()
+        return psycopg2.Binary(value)
+
+    def convert_to_read(self, value, record, use_name_get=True):
+        if not value or not isinstance(value, bytes):
+            return value or False
+        return base64.b64encode(value).decode()
 
 
 class MQTTMessage(models.Model):
@@ -24,7 +72,15 @@ class MQTTMessage(models.Model):
         return [
             ("draft", _("Draft")),
             ("enqueued", _("Enqueued")),
+            ("sent", _("Sent")),
             ("processed", _("Processed")),
+            ("dead", _("Dead")),
+        ]
+
+    def _get_payload_encodings(self):
+        return [
+            ("text", _("Text")),
+            ("binary", _("Binary")),
         ]
 
     def _get_directions(self):
@@ -37,13 +93,49 @@ class MQTTMessage(models.Model):
     direction = fields.Selection("_get_directions", default="outgoing", readonly=True)
     enqueue_date = fields.Datetime("Enqueued on", readonly=True)
     process_date = fields.Datetime("Processed on", readonly=True)
+    next_attempt = fields.Datetime(
+        readonly=True,
+        help="The router skips the message until the next retry of a failed delivery",
+    )
+    topic_id = fields.Many2one(
+        "mqtt.topic",
+        "Topic Entry",
+        ondelete="restrict",
+        index=True,
+        readonly=True,
+    )
     topic = fields.Char(
+        compute="_compute_topic",
+        inverse="_inverse_topic",
+        search="_search_topic",
         readonly=True,
         states={"draft": [("readonly", False)]},
     )
     payload = fields.Text(
+        compute="_compute_payload",
+        inverse="_inverse_payload",
         readonly=True,
         states={"draft": [("readonly", False)]},
+        help="Binary payloads are shown encoded with base64",
+    )
+    payload_data = RawBinary(attachment=False, prefetch=False, readonly=True)
+    payload_encoding = fields.Selection(
+        "_get_payload_encodings",
+        default="text",
+        required=True,
+        readonly=True,
+    )
+    payload_codec = fields.Selection(
+        PAYLOAD_CODECS,
+        "Compression",
+        default="none",
+        required=True,
+        readonly=True,
+    )
+    payload_size = fields.Integer(
+        default=0,
+        readonly=True,
+        help="Size of the uncompressed payload in bytes",
     )
     qos = fields.Selection(
         default="0",
@@ -61,25 +153,54 @@ class MQTTMessage(models.Model):
         help="The number of subscribed functions to the topic of the message",
     )
     subscriptions = fields.Html(compute="_compute_subscription", translate=False)
+    delivery_ids = fields.One2many("mqtt.delivery", "message_id", readonly=True)
+    error = fields.Text(
+        readonly=True,
+        help="The errors of the subscribers which failed to process the message",
+    )
 
     @api.onchange("topic")
     def _onchange_topic(self):
         if self.topic and any(k in self.topic for k in "#+"):
             raise ValidationError(_("Topic can't include # or + as character"))
 
+    @api.depends("topic_id.topic")
+    def _compute_topic(self):
+        for rec in self:
+            rec.topic = rec.topic_id.topic
+
+    def _inverse_topic(self):
+        for rec in self:
+            rec.write({"topic": rec.topic})
+
+    def _search_topic(self, operator, value):
+        if value is False and operator in ("=", "!="):
+            return [("topic_id", operator, False)]
+        return [("topic_id.topic", operator, value)]
+
+    @api.model
+    def _get_topic_ids(self, topics):
+        """Intern the topics of the messages. Returns a dictionary mapping the
+        topics to their IDs"""
+        return self.env["mqtt.topic"]._intern(topics)
+
+    @api.model
+    def _replace_topic(self, vals, topic_ids):
+        """Replace the topic in the values with the interned topic"""
+        if "topic" not in vals:
+            return vals
+
+        vals = dict(vals)
+        vals["topic_id"] = topic_ids.get(vals.pop("topic"), False)
+        return vals
+
     def _compute_subscriber(self):
         """Counter the number of subscriber for a message"""
         subs = {rec: 0 for rec in self}
 
         # Subscribing only works for incoming messages
         messages = self.filtered_domain([("direction", "=", "incoming")])
-        for _model, _attr, func in self._mqtt_functions():
-            subbed = messages._filter_by_subscription(func._mqtt)
-            for rec in subbed:
-                subs[rec] += 1
-
-        for processor in self.env["mqtt.processor"].search([]):
-            subbed = messages._filter_by_subscription(processor.topic)
+        for subbed in messages._group_by_subscriber().values():
             for rec in subbed:
                 subs[rec] += 1
 
@@ -89,18 +210,13 @@ class MQTTMessage(models.Model):
     def _compute_subscription(self):
         """Counter the number of subscriber for a message"""
         subs = {rec: defaultdict(set) for rec in self}
+        titles = {"api": _("API"), "processor": _("Processor")}
 
         # Subscribing only works for incoming messages
         messages = self.filtered_domain([("direction", "=", "incoming")])
-        for _model, _attr, func in self._mqtt_functions():
-            subbed = messages._filter_by_subscription(func._mqtt)
-            for rec in subbed:
-                subs[rec][_("API")].add(func._mqtt)
-
-        for processor in self.env["mqtt.processor"].search([]):
-            subbed = messages._filter_by_subscription(processor.topic)
+        for subscriber, subbed in messages._group_by_subscriber().items():
             for rec in subbed:
-                subs[rec][_("Processor")].add(processor.topic)
+                subs[rec][titles[subscriber.kind]].add(subscriber.topic)
 
         for rec, subscriptions in subs.items():
             content = ""
@@ -110,10 +226,113 @@ class MQTTMessage(models.Model):
                 content += "</ul>"
             rec.subscriptions = content
 
+    @api.depends("payload_data", "payload_codec", "payload_encoding")
+    def _compute_payload(self):
+        # The payloads aren't prefetched with the other fields but reading the
+        # first one fetches them for the whole recordset
+        for rec, raw in zip(self, self.with_context(bin_size=False)):
+            data = unpack_payload(raw.payload_data, rec.payload_codec)
+            if not data:
+                rec.payload = False
+            elif rec.payload_encoding == "binary":
+                rec.payload = base64.b64encode(data).decode()
+            else:
+                rec.payload = data.decode("utf-8")
+
+    def _inverse_payload(self):
+        # Create and write store the payload directly. This is only reached by
+        # assignments in forms
+        for rec in self:
+            vals = {"payload": rec.payload}
+            rec.write(self._replace_payload(vals, rec.payload_encoding))
+
+    @api.model
+    def _replace_payload(self, vals, encoding=None):
+        """Replace the payload in the values with the values to store it. Binary
+        payloads are expected to be encoded with base64"""
+        if "payload" not in vals:
+            return vals
+
+        vals = dict(vals)
+        payload = vals.pop("payload")
+        encoding = vals.get("payload_encoding", encoding)
+        if payload and encoding == "binary" and isinstance(payload, str):
+            try:
+                payload = base64.b64decode(payload, validate=True)
+            except binascii.Error as e:
+                raise ValidationError(
+                    _("Binary payloads must be encoded with base64")
+                ) from e
+
+        vals.update(self._prepare_payload_vals(payload, encoding))
+        return vals
+
+    @api.model
+    def _get_payload_compression(self):
+        """Returns the compression codec and the threshold in bytes"""
+        return get_compression(self.env["ir.config_parameter"].sudo().get_param)
+
+    @api.model
+    def _prepare_payload_vals(self, payload, encoding=None):
+        """Returns the values to store the payload compressed if it exceeds the
+        configured threshold"""
+        codec, threshold = self._get_payload_compression()
+        data, codec, size, encoding = pack_payload(
+            payload, codec, threshold, encoding=encoding
+        )
+        return {
+            "payload_data": data,
+            "payload_codec": codec,
+            "payload_size": size,
+            "payload_encoding": encoding,
+        }
+
+    def get_payload(self):
+        """Returns the payload as string or as bytes for binary payloads"""
+        self.ensure_one()
+        if self.payload and self.payload_encoding == "binary":
+            return base64.b64decode(self.payload)
+        return self.payload
+
+    def decode(self, payload_format="json"):
+        """Decode the payload using the format"""
+        self.ensure_one()
+        payload = self.get_payload()
+        return decode_payload(payload, payload_format) if payload else None
+
     def json(self):
         """Interpret the payload as json"""
-        self.ensure_one()
-        return json.loads(self.payload) if self.payload else None
+        return self.decode("json")
+
+    def init(self):
+        res = super().init()
+
+        # Partial indexes for the queues and the garbage collection which stay
+        # small independent of the number of stored messages
+        indexes = {
+            "mqtt_message_outgoing_queue_index": (
+                "enqueue_date, id",
+                "state = 'enqueued' AND direction = 'outgoing'",
+            ),
+            "mqtt_message_incoming_queue_index": (
+                "id, next_attempt",
+                "state = 'enqueued' AND direction = 'incoming'",
+            ),
+            "mqtt_message_gc_index": (
+                "direction, write_date",
+                "state = 'processed'",
+            ),
+            # Used by the statistics of the topics
+            "mqtt_message_create_date_index": ("create_date", None),
+        }
+        for name, (columns, where) in indexes.items():
+            if not tools.index_exists(self.env.cr, name):
+                where = f" WHERE {where}" if where else ""
+                self.env.cr.execute(
+                    f"CREATE INDEX {name} ON {self._table} ({columns}){where}"
+                )
+
+        return res
 
     @api.autovacuum
     def _gc_messages(self):
@@ -129,93 +348,323 @@ class MQTTMessage(models.Model):
         except ValueError:
             hours = DEFAULT_GC_HOURS
 
-        domain = [
-            ("write_date", "<", datetime.now() - timedelta(hours=hours)),
-            ("state", "=", "processed"),
-            ("direction", "in", directions.split(",")),
-        ]
-        self.search(domain).unlink()
-
-    @api.model
-    def _convert_subscription(self, subscription):
-        """Convert the subscription wildcard into a regex expression"""
-        pattern = []
-        for part in subscription.split("/"):
-            if part == "+":
-                pattern.append(r"[^/]*")
-            elif part == "#":
-                pattern.append(r".*")
-                return rf"^{r'/'.join(pattern)}$"
-            elif any(k in part for k in "+#"):
-                return False
-            else:
-                pattern.append(part.replace("$", r"\$"))
-
-        return rf"^{r'/'.join(pattern)}$"
+        try:
+            chunk = int(param("mqtt.message_vacuum_chunk", DEFAULT_GC_CHUNK))
+        except ValueError:
+            chunk = DEFAULT_GC_CHUNK
+
+        chunk = max(chunk, 1)
+
+        # Count the messages in the statistics of the topics before deleting them
+        self.env["mqtt.topic"]._update_statistics()
+
+        # Delete the messages in chunks directly to keep the locks short. The
+        # deliveries are removed by the foreign key. Messages which aren't part
+        # of the statistics yet are kept
+        self.flush()
+        delay = max(timedelta(hours=hours), timedelta(minutes=STATISTICS_DELAY))
+        limit = datetime.now() - delay
+        while True:
+            self.env.cr.execute(
+                """
+                DELETE FROM mqtt_message WHERE id IN (
+                    SELECT id FROM mqtt_message
+                    WHERE state = 'processed' AND direction IN %s
+                        AND write_date < %s
+                    LIMIT %s
+                )
+                """,
+                (tuple(directions.split(",")), limit, chunk),
+            )
+            deleted = self.env.cr.rowcount
+            # pylint: disable=E8102
+            self.env.cr.commit()
+            _logger.debug(f"Deleted {deleted} MQTT messages")
+            if deleted < chunk:
+                break
+
+        self.invalidate_cache()
+
+    @tools.ormcache()
+    def _get_subscription_trie(self):
+        """Build the topic trie of all subscribers. The trie is cached until the
+        registry is reloaded or the processors change"""
+        trie = TopicTrie()
+        for handler in self._get_mqtt_handlers():
+            target = (handler.model, handler.method)
+            trie.add(handler.topic, Subscriber("api", target, handler.topic))
+
+        for processor in self.env["mqtt.processor"].sudo().search([]):
+            subscriber = Subscriber("processor", processor.id, processor.topic)
+            trie.add(processor.topic, subscriber)
+
+        return trie
+
+    def _group_by_subscriber(self):
+        """Match the messages against all subscribers at once. Returns a
+        dictionary mapping the subscribers to the matching messages"""
+        trie = self._get_subscription_trie()
+
+        # Match every distinct topic only once
+        matches, groups = {}, defaultdict(list)
+        for rec in self:
+            topic = rec.topic_id
+            if topic.id not in matches:
+                matches[topic.id] = trie.match(topic.topic) if topic else []
+
+            for subscriber in matches[topic.id]:
+                groups[subscriber].append(rec.id)
+
+        return {
+            subscriber: self.browse(groups[subscriber])
+            for subscriber in sorted(groups, key=trie.order.get)
+        }
 
     def _filter_by_subscription(self, subscription):
         """Filter the recordset by the MQTT wildcard"""
-        if not self:
-            return self
-
-        pattern = self._convert_subscription(subscription)
-        if not pattern:
+        trie = TopicTrie()
+        if not self or not trie.add(subscription, True):
             return self.browse()
 
-        query = "SELECT id FROM mqtt_message WHERE topic ~ %s AND id IN %s"
-        self.env.cr.execute(query, (pattern, tuple(self.ids)))
-        ids = self.env.cr.fetchall()
-        return self.browse([x[0] for x in ids])
+        topics = self.mapped("topic_id").filtered(lambda t: trie.match(t.topic))
+        return self.filtered(lambda rec: rec.topic_id in topics)
 
-    def _run_mqtt_router_api(self, messages):
-        now = datetime.now()
-        for model, attr, func in self._mqtt_functions():
-            _logger.debug(f"Calling {model}.{attr}()")
+    def _get_undelivered(self, groups):
+        """Remove the messages which were already delivered to a subscriber or
+        which are waiting for the next attempt"""
+        states = self.env["mqtt.delivery"]._get_states_by_message(self)
+        now = fields.Datetime.now()
 
-            subbed = messages._filter_by_subscription(func._mqtt)
-            if not subbed:
-                continue
+        def pending(msg, key):
+            state, next_attempt = states[msg.id].get(key, (None, None))
+            if state in ("done", "dead"):
+                return False
+            return not next_attempt or next_attempt <= now
+
+        result = {}
+        for subscriber, subbed in groups.items():
+            subbed = subbed.filtered(lambda m: pending(m, subscriber.key))
+            if subbed:
+                result[subscriber] = subbed
+        return result
+
+    def _finish_deliveries(self, groups):
+        """Mark the messages as processed once every subscriber processed them.
+        Messages which exceeded the retries of a subscriber are dead. Messages
+        without any subscriber are processed because nobody waits for them. The
+        router skips the other messages until their next attempt"""
+        expected = defaultdict(set)
+        for subscriber, subbed in groups.items():
+            for msg_id in subbed.ids:
+                expected[msg_id].add(subscriber.key)
+
+        states = self.env["mqtt.delivery"]._get_states_by_message(self)
+        processed = [msg_id for msg_id in self.ids if msg_id not in expected]
+        dead, retries = [], defaultdict(list)
+        for msg_id, keys in expected.items():
+            msg_states = [states[msg_id].get(key, (None, None)) for key in keys]
+            found = {state for state, _next in msg_states}
+            if found == {"done"}:
+                processed.append(msg_id)
+            elif found <= {"done", "dead"}:
+                dead.append(msg_id)
+            else:
+                # Postpone the message until the earliest retry of a subscriber
+                pending = [
+                    next_attempt
+                    for state, next_attempt in msg_states
+                    if state not in ("done", "dead")
+                ]
+                retries[min(pending) if all(pending) else False].append(msg_id)
 
-            try:
-                # Make the messages appear to be newly received if
-                # multiple routes are used for the same message
-                subbed.write({"state": "enqueued"})
-                func(model, subbed.with_context(mqtt_lock=True))
-                subbed.write({"state": "processed", "process_date": now})
-                # pylint: disable=E8102
-                self.env.cr.commit()
-            except Exception:
-                _logger.exception(f"Failed {model}.{attr}()")
-                self.env.cr.rollback()
-
-    def _run_mqtt_router_processor(self, messages):
         now = datetime.now()
-        for processor in self.env["mqtt.processor"].search([]):
-            subbed = messages._filter_by_subscription(processor.topic)
-            if not subbed:
+        self.browse(processed).write({"state": "processed", "process_date": now})
+        for next_attempt, msg_ids in retries.items():
+            self.browse(msg_ids).write({"next_attempt": next_attempt})
+        for msg in self.browse(dead):
+            failed = msg.delivery_ids.filtered(lambda d: d.state == "dead")
+            error = "\n".join(f"{d.subscriber}:\n{d.error}" for d in failed)
+            msg.write({"state": "dead", "process_date": now, "error": error})
+
+    def _try_router_lock(self):
+        """Take the lock of the router for the current transaction"""
+        self.env.cr.execute("SELECT pg_try_advisory_xact_lock(%s)", (ROUTER_LOCK,))
+        return self.env.cr.fetchone()[0]
+
+    def _end_delivery(self, commit=True):
+        """Commit or roll back the delivery. Both release the lock of the
+        router which must be taken again to continue routing"""
+        # pylint: disable=E8102
+        if commit:
+            self.env.cr.commit()
+        else:
+            self.env.cr.rollback()
+
+        if self.env.context.get("mqtt_router_lock") and not self._try_router_lock():
+            raise RouterLockLost()
+
+    def _deliver(self, subscriber):
+        """Deliver the messages to the subscriber and record the result in the
+        delivery ledger. Failing batches are split to isolate the first failing
+        message. The messages after it stay undelivered and are retried by the
+        next run of the router. Returns True if the subscriber processed all
+        messages"""
+        deliveries = self.env["mqtt.delivery"]
+        try:
+            self._call_subscriber(subscriber, self.with_context(mqtt_lock=True))
+            deliveries._register(self, subscriber, "done")
+        except Exception:
+            self._end_delivery(commit=False)
+            if len(self) > 1:
+                half = len(self) // 2
+                if not self[:half]._deliver(subscriber):
+                    return False
+                return self[half:]._deliver(subscriber)
+
+            _logger.exception(f"Failed to deliver {self} to {subscriber.key}")
+            deliveries._register(self, subscriber, "failed", traceback.format_exc())
+            self._end_delivery()
+            return False
+
+        self._end_delivery()
+        return True
+
+    def _run_mqtt_router_api(self, messages, groups=None):
+        if groups is None:
+            groups = messages._get_undelivered(messages._group_by_subscriber())
+
+        for subscriber, subbed in groups.items():
+            if subscriber.kind == "api":
+                _logger.debug(f"Calling {subscriber.key}")
+                subbed._deliver(subscriber)
+
+    def _run_mqtt_router_processor(self, messages, groups=None):
+        if groups is None:
+            groups = messages._get_undelivered(messages._group_by_subscriber())
+
+        for subscriber, subbed in groups.items():
+            if subscriber.kind == "processor":
+                subbed._deliver(subscriber)
+
+    def _call_subscriber(self, subscriber, messages):
+        if subscriber.kind == "api":
+            model_name, attr = subscriber.target
+            getattr(self.env[model_name], attr)(messages)
+        elif subscriber.kind == "processor":
+            self.env["mqtt.processor"].browse(subscriber.target).process(messages)
+
+    def _get_router_workers(self):
+        try:
+            param = self.env["ir.config_parameter"].sudo().get_param
+            return max(int(param("mqtt.router_workers", 1)), 1)
+        except ValueError:
+            return 1
+
+    def _get_router_partitions(self, groups):
+        """Split the work into partitions which can run concurrently. The
+        messages of a partition are processed in order by a single subscriber"""
+        param = self.env["ir.config_parameter"].sudo().get_param
+        by_topic = param("mqtt.router_partition", "subscriber") == "topic"
+
+        partitions = []
+        for subscriber, subbed in groups.items():
+            if not by_topic:
+                partitions.append((subscriber, subbed))
                 continue
 
-            try:
-                # Make the messages appear to be newly received if
-                # multiple routes are used for the same message
-                subbed.write({"state": "enqueued"})
-                processor.process(subbed.with_context(mqtt_lock=True))
-                subbed.write({"state": "processed", "process_date": now})
-                # pylint: disable=E8102
-                self.env.cr.commit()
-            except Exception as e:
-                _logger.exception(e)
-                self.env.cr.rollback()
-
-    def _run_mqtt_router(self):
-        """Route the newly received messages"""
+            topics = defaultdict(list)
+            for rec in subbed:
+                topics[rec.topic_id.id].append(rec.id)
+
+            partitions.extend((subscriber, self.browse(ids)) for ids in topics.values())
+
+        return partitions
+
+    def _run_mqtt_router_partition(self, subscriber, message_ids):
+        """Deliver the messages in a separate transaction"""
+        with self.pool.cursor() as cr:
+            # The lock of the router is held by the main transaction
+            context = dict(self.env.context, mqtt_router_lock=False)
+            env = api.Environment(cr, self.env.uid, context)
+            return env[self._name].browse(message_ids)._deliver(subscriber)
+
+    def _run_mqtt_router_parallel(self, groups, workers):
+        """Run the partitions concurrently each with its own cursor"""
+        partitions = self._get_router_partitions(groups)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._run_mqtt_router_partition, sub, subbed.ids)
+                for sub, subbed in partitions
+            ]
+            for future in futures:
+                future.result()
+
+        # The deliveries were committed by other cursors
+        self.invalidate_cache()
+
+    def _run_mqtt_router(self, limit=None, after_id=0):
+        """Route the newly received messages ordered by their ID. Returns the
+        routed messages which allows to continue after the last one. The router
+        is used by the runner and the cron which is only a sweeper for messages
+        the runner didn't handle"""
         if not self.env.is_admin():
             raise AccessDenied()
 
-        domain = [("state", "=", "enqueued"), ("direction", "=", "incoming")]
-        messages = self.search(domain)
-        self._run_mqtt_router_api(messages)
-        self._run_mqtt_router_processor(messages)
+        # The lock is released with the transaction even if the routing fails
+        if not self._try_router_lock():
+            _logger.debug("MQTT router is already running")
+            return self.browse()
+
+        try:
+            domain = [
+                ("state", "=", "enqueued"),
+                ("direction", "=", "incoming"),
+                ("id", ">", after_id),
+                "|",
+                ("next_attempt", "=", False),
+                ("next_attempt", "<=", fields.Datetime.now()),
+            ]
+            messages = self.with_context(mqtt_router_lock=True).search(
+                domain, limit=limit, order="id"
+            )
+            groups = messages._group_by_subscriber()
+            undelivered = messages._get_undelivered(groups)
+            workers = self._get_router_workers()
+            if workers > 1:
+                messages._run_mqtt_router_parallel(undelivered, workers)
+            else:
+                messages._run_mqtt_router_api(messages, undelivered)
+                messages._run_mqtt_router_processor(messages, undelivered)
+
+            messages._finish_deliveries(groups)
+            return messages.with_context(mqtt_router_lock=False)
+        except RouterLockLost:
+            # The other router continues with the remaining messages
+            _logger.info("MQTT router lock was taken by another router")
+            return self.browse()
+
+    def _notify_publish(self):
+        """Wake up the runner if there are messages to publish"""
+        domain = [("state", "=", "enqueued"), ("direction", "=", "outgoing")]
+        if self.filtered_domain(domain):
+            self._notify_runner("publish")
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        topic_ids = self._get_topic_ids([vals.get("topic") for vals in vals_list])
+        vals_list = [
+            self._replace_payload(self._replace_topic(vals, topic_ids))
+            for vals in vals_list
+        ]
+        records = super().create(vals_list)
+        records._notify_publish()
+        return records
+
+    def action_retry(self):
+        """Give the dead messages another chance"""
+        recs = self.filtered_domain([("state", "=", "dead")])
+        recs.mapped("delivery_ids").filtered(lambda d: d.state == "dead").unlink()
+        recs.write({"state": "enqueued", "error": False, "next_attempt": False})
 
     def action_enqueue(self):
         recs = self.filtered_domain([("state", "=", "draft")])
@@ -227,4 +676,25 @@ class MQTTMessage(models.Model):
         to the messages"""
         if self.env.context.get("mqtt_lock"):
             return True
-        return super().write(vals)
+
+        # The payload is stored in the encoding of each message
+        if "payload" in vals:
+            encodings = defaultdict(list)
+            for rec in self:
+                encoding = vals.get("payload_encoding", rec.payload_encoding)
+                encodings[encoding].append(rec.id)
+
+            res = True
+            for encoding, ids in encodings.items():
+                recs = self.browse(ids)
+                res = recs.write(self._replace_payload(vals, encoding)) and res
+            return res
+
+        if "topic" in vals:
+            topic_ids = self._get_topic_ids([vals["topic"]])
+            vals = self._replace_topic(vals, topic_ids)
+
+        res = super().write(vals)
+        if vals.get("state") == "enqueued":
+            self._notify_publish()
+        return res
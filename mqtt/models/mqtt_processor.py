@@ -5,6 +5,9 @@ from odoo import _, api, fields, models
 from odoo.exceptions import UserError
 from odoo.tools import safe_eval
 
+from ..formats import PAYLOAD_FORMATS
+from ..snippet import snippets
+
 
 class MQTTProcessor(models.Model):
     _name = "mqtt.processor"
@@ -29,6 +32,12 @@ class MQTTProcessor(models.Model):
         required=True,
         help="Subscribed topic. MQTT wildcards with # and + are allowed",
     )
+    payload_format = fields.Selection(
+        PAYLOAD_FORMATS,
+        default="json",
+        required=True,
+        help="Format used by the decode function to read the payload of messages",
+    )
     help_text = fields.Html(compute="_compute_help_text", readonly=True, store=False)
     code = fields.Text(default=lambda self: self._get_default_code())
 
@@ -47,6 +56,7 @@ class MQTTProcessor(models.Model):
         """Informations about the available variables in the python code"""
         return {
             "client": "The ID of the MQTT client",
+            "decode": "Function to decode the payload of a message",
             "env": "Odoo Environment on which the processing is triggered",
             "messages": "The messages to process",
             "model": "Odoo Model on whoch the processing is triggered",
@@ -54,15 +64,33 @@ class MQTTProcessor(models.Model):
             "UserError": "Warning Exception to use with raise",
         }
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        # Rebuild the subscription trie of the messages
+        self.clear_caches()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {"active", "topic"}.intersection(vals):
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
     def _get_model(self):
         self.ensure_one()
         return self.env[self.model_id.model].with_user(self.user_id)
 
     def _get_eval_context(self):
         self.ensure_one()
-        icp = self.env["ir.config_parameter"].sudo()
         return {
-            "client": icp.get_param("mqtt.uuid", None),
+            "client": self.env["ir.config_parameter"]._get_mqtt_client_id(),
+            "decode": lambda message: message.decode(self.payload_format),
             "datetime": safe_eval.datetime,
             "env": self.env(user=self.user_id),
             "model": self._get_model(),
@@ -77,4 +105,4 @@ class MQTTProcessor(models.Model):
 
         context = self._get_eval_context()
         context["messages"] = messages.with_user(self.user_id)
-        safe_eval.safe_eval(self.code, context, mode="exec", nocopy=True)
+        snippets.run(self, "code", context)
@@ -1,7 +1,7 @@
 # © 2022 Florian Kantelberg - initOS GmbH
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import _, fields, models
+from odoo import _, api, fields, models
 
 
 class MQTTSubscription(models.Model):
@@ -14,3 +14,19 @@ class MQTTSubscription(models.Model):
         help="The topic under which messages will get published. Use {client} to "
         "insert the ID of the MQTT client",
     )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self._notify_runner("subscribe")
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {"active", "qos", "topic"}.intersection(vals):
+            self._notify_runner("subscribe")
+        return res
+
+    def unlink(self):
+        self._notify_runner("subscribe")
+        return super().unlink()
@@ -0,0 +1,171 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+from odoo import _, api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# Minutes the statistics trail behind the creation of the messages. Messages of
+# transactions which are still running aren't visible yet and would be missed
+STATISTICS_DELAY = 10
+
+
+def intern_topics(cr, topics):
+    """Returns a dictionary mapping the topics to their IDs and inserts the
+    missing ones. Existing topics are locked with a key share lock which keeps
+    the garbage collection from deleting them until the transaction ends. The
+    lock doesn't conflict with other transactions using or updating the topics.
+    The statistics are updated later by `mqtt.topic`"""
+    topics = sorted(set(filter(None, topics)))
+    if not topics:
+        return {}
+
+    query = "SELECT topic, id FROM mqtt_topic WHERE topic IN %s FOR KEY SHARE"
+    cr.execute(query, (tuple(topics),))
+    result = dict(cr.fetchall())
+    missing = [topic for topic in topics if topic not in result]
+    if not missing:
+        return result
+
+    rows = []
+    for topic in missing:
+        levels = topic.split("/")
+        rows.append((topic, len(levels), levels[0]))
+
+    result.update(
+        execute_values(
+            cr._obj,
+            """
+            INSERT INTO mqtt_topic (
+                topic, depth, root, incoming_count, outgoing_count, first_seen
+            ) VALUES %s
+            ON CONFLICT (topic) DO NOTHING
+            RETURNING topic, id
+            """,
+            rows,
+            template="(%s, %s, %s, 0, 0, (now() at time zone 'UTC'))",
+            page_size=len(rows),
+            fetch=True,
+        )
+    )
+
+    # The insert waits for concurrent transactions inserting the same topics.
+    # With REPEATABLE READ, postgres raises a serialization failure if they
+    # commit and the whole transaction is retried by Odoo or the runner. With
+    # READ COMMITTED, the committed topics are visible to the next statement
+    missing = [topic for topic in missing if topic not in result]
+    if missing:
+        cr.execute(query, (tuple(missing),))
+        result.update(cr.fetchall())
+    return result
+
+
+class MQTTTopic(models.Model):
+    _name = "mqtt.topic"
+    _description = _("MQTT Topic")
+    _order = "topic"
+    _rec_name = "topic"
+    _log_access = False
+
+    topic = fields.Char(required=True, readonly=True)
+    depth = fields.Integer(readonly=True, help="Number of levels of the topic")
+    root = fields.Char(readonly=True, index=True, help="First level of the topic")
+    first_seen = fields.Datetime(readonly=True)
+    last_seen = fields.Datetime(readonly=True)
+    incoming_count = fields.Integer(
+        "Incoming Messages",
+        default=0,
+        readonly=True,
+        help="Number of received messages with the topic. The statistics are "
+        "updated periodically",
+    )
+    outgoing_count = fields.Integer(
+        "Outgoing Messages",
+        default=0,
+        readonly=True,
+        help="Number of published messages with the topic. The statistics are "
+        "updated periodically",
+    )
+
+    _sql_constraints = [
+        ("topic_uniq", "UNIQUE(topic)", _("The topic must be unique")),
+    ]
+
+    @api.model
+    def _intern(self, topics):
+        """Returns a dictionary mapping the topics to their IDs"""
+        topics = set(filter(None, topics))
+        if not topics:
+            return {}
+
+        self.flush(["topic"])
+        return intern_topics(self.env.cr, topics)
+
+    @api.model
+    def _update_statistics(self, delay=STATISTICS_DELAY):
+        """Count the messages which were created since the last update. The
+        counts keep the messages which were deleted afterwards. Messages which
+        were created within the last minutes given by `delay` are counted by a
+        later update because their transactions might not be committed yet"""
+        icp = self.env["ir.config_parameter"].sudo()
+        try:
+            last_date = datetime.fromisoformat(
+                icp.get_param("mqtt.topic_statistics_date", "")
+            )
+        except ValueError:
+            last_date = datetime.min
+
+        self.env["mqtt.message"].flush(["topic_id", "direction", "create_date"])
+        cr = self.env.cr
+        cr.execute(
+            "SELECT (now() at time zone 'UTC') - interval '1 minute' * %s", (delay,)
+        )
+        until = cr.fetchone()[0]
+        if until <= last_date:
+            return
+
+        self.flush()
+        cr.execute(
+            """
+            UPDATE mqtt_topic t
+            SET last_seen = GREATEST(t.last_seen, s.last_seen),
+                incoming_count = t.incoming_count + s.incoming,
+                outgoing_count = t.outgoing_count + s.outgoing
+            FROM (
+                SELECT topic_id, MAX(create_date) AS last_seen,
+                    COUNT(*) FILTER (WHERE direction = 'incoming') AS incoming,
+                    COUNT(*) FILTER (WHERE direction = 'outgoing') AS outgoing
+                FROM mqtt_message
+                WHERE create_date > %s AND create_date <= %s
+                    AND topic_id IS NOT NULL
+                GROUP BY topic_id
+            ) s
+            WHERE t.id = s.topic_id
+            """,
+            (last_date, until),
+        )
+        icp.set_param("mqtt.topic_statistics_date", until.isoformat(" "))
+        self.invalidate_cache()
+
+    @api.autovacuum
+    def _gc_topics(self):
+        """Update the statistics and delete the topics without messages. Topics
+        which are referenced by uncommitted messages are locked and skipped"""
+        self._update_statistics()
+        self.env["mqtt.message"].flush(["topic_id"])
+        self.env.cr.execute(
+            """
+            DELETE FROM mqtt_topic WHERE id IN (
+                SELECT id FROM mqtt_topic t
+                WHERE NOT EXISTS (SELECT 1 FROM mqtt_message m WHERE m.topic_id = t.id)
+                FOR UPDATE SKIP LOCKED
+            )
+            """
+        )
+        _logger.debug(f"Deleted {self.env.cr.rowcount} MQTT topics")
+        self.invalidate_cache()
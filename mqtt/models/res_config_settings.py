@@ -1,7 +1,10 @@
 # © 2022 Florian Kantelberg - initOS GmbH
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import fields, models
+from odoo import _, api, fields, models
+from odoo.exceptions import ValidationError
+
+from ..payload import PAYLOAD_CODECS
 
 
 class ResConfigSettings(models.TransientModel):
@@ -10,6 +13,26 @@ class ResConfigSettings(models.TransientModel):
     mqtt_gc_incoming = fields.Boolean()
     mqtt_gc_outgoing = fields.Boolean()
     mqtt_gc_hours = fields.Integer()
+    mqtt_router_workers = fields.Integer()
+    mqtt_router_partition = fields.Selection(
+        [("subscriber", "Subscriber"), ("topic", "Subscriber and Topic")],
+    )
+    mqtt_router_retry_delay = fields.Integer()
+    mqtt_router_max_attempts = fields.Integer()
+    mqtt_payload_compression = fields.Selection(PAYLOAD_CODECS)
+    mqtt_payload_threshold = fields.Integer()
+
+    @api.constrains(
+        "mqtt_router_retry_delay", "mqtt_router_max_attempts", "mqtt_payload_threshold"
+    )
+    def _check_mqtt_router(self):
+        for rec in self:
+            if rec.mqtt_router_retry_delay < 0:
+                raise ValidationError(_("The retry delay can't be negative"))
+            if rec.mqtt_router_max_attempts < 1:
+                raise ValidationError(_("At least one attempt is required"))
+            if rec.mqtt_payload_threshold < 0:
+                raise ValidationError(_("The payload threshold can't be negative"))
 
     def get_values(self):
         res = super().get_values()
@@ -23,6 +46,24 @@ class ResConfigSettings(models.TransientModel):
             hours = 12
 
         res["mqtt_gc_hours"] = hours
+
+        try:
+            workers = int(icp.get_param("mqtt.router_workers", 1))
+        except ValueError:
+            workers = 1
+
+        res["mqtt_router_workers"] = workers
+        res["mqtt_router_partition"] = icp.get_param(
+            "mqtt.router_partition", "subscriber"
+        )
+
+        delay, attempts = self.env["mqtt.delivery"]._get_retry_config()
+        res["mqtt_router_retry_delay"] = delay
+        res["mqtt_router_max_attempts"] = attempts
+
+        codec, threshold = self.env["mqtt.message"]._get_payload_compression()
+        res["mqtt_payload_compression"] = codec
+        res["mqtt_payload_threshold"] = threshold
         return res
 
     def set_values(self):
@@ -31,3 +72,11 @@ class ResConfigSettings(models.TransientModel):
         icp = self.env["ir.config_parameter"].sudo()
         icp.set_param("mqtt.message_vacuum", ",".join(gc))
         icp.set_param("mqtt.message_vacuum_hours", str(self.mqtt_gc_hours))
+        icp.set_param("mqtt.router_workers", str(self.mqtt_router_workers))
+        icp.set_param("mqtt.router_partition", self.mqtt_router_partition)
+        icp.set_param("mqtt.router_retry_delay", str(self.mqtt_router_retry_delay))
+        icp.set_param("mqtt.router_max_attempts", str(self.mqtt_router_max_attempts))
+        icp.set_param(
+            "mqtt.payload_compression", self.mqtt_payload_compression or "none"
+        )
+        icp.set_param("mqtt.payload_threshold", str(self.mqtt_payload_threshold))
@@ -0,0 +1,65 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import lzma
+import zlib
+
+# Compression of the stored payloads. Payloads are only compressed above the
+# threshold and if the compression reduces the size
+PAYLOAD_CODECS = [
+    ("none", "None"),
+    ("zlib", "zlib"),
+    ("lzma", "LZMA"),
+]
+DEFAULT_CODEC = "zlib"
+DEFAULT_THRESHOLD = 4096
+
+_COMPRESS = {"zlib": zlib.compress, "lzma": lzma.compress}
+_DECOMPRESS = {"zlib": zlib.decompress, "lzma": lzma.decompress}
+
+
+def get_compression(param):
+    """Returns the codec and the threshold in bytes from the configuration.
+    The parameter is a function like `get_param` of `ir.config_parameter`"""
+    codec = param("mqtt.payload_compression", DEFAULT_CODEC)
+    if codec not in _COMPRESS:
+        codec = "none"
+
+    try:
+        threshold = int(param("mqtt.payload_threshold", DEFAULT_THRESHOLD))
+    except (TypeError, ValueError):
+        threshold = DEFAULT_THRESHOLD
+
+    return codec, max(threshold, 0)
+
+
+def pack_payload(payload, codec="none", threshold=DEFAULT_THRESHOLD, encoding=None):
+    """Prepare a payload for the storage. Strings are stored encoded with UTF-8
+    and bytes as binary payload unless the encoding is given. Returns the stored
+    bytes, the codec, the uncompressed size and the encoding"""
+    if isinstance(payload, str):
+        data, encoding = payload.encode("utf-8"), encoding or "text"
+    else:
+        data, encoding = payload or b"", encoding or "binary"
+
+    size = len(data)
+    if not data:
+        return None, "none", 0, encoding
+
+    if codec in _COMPRESS and size >= threshold:
+        compressed = _COMPRESS[codec](data)
+        if len(compressed) < size:
+            return compressed, codec, size, encoding
+
+    return data, "none", size, encoding
+
+
+def unpack_payload(data, codec="none"):
+    """Returns the uncompressed bytes of a stored payload"""
+    if not data:
+        return b""
+
+    data = bytes(data)
+    if codec in _DECOMPRESS:
+        return _DECOMPRESS[codec](data)
+    return data
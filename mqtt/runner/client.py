@@ -2,14 +2,26 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import logging
+import os
+import queue
+import select
+import threading
 import time
 from contextlib import contextmanager
 from datetime import datetime
 
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, TransactionRollbackError
+from psycopg2.extras import execute_values
+
 import odoo
 from odoo import api, fields
 from odoo.tools import config
 
+from ..models.mqtt_base import NOTIFY_CHANNEL
+from ..models.mqtt_topic import intern_topics
+from ..payload import get_compression, pack_payload, unpack_payload
+
 try:
     import paho.mqtt.client as mqtt
 except ImportError:
@@ -19,6 +31,17 @@ except ImportError:
 _logger = logging.getLogger(__name__)
 
 DEFAULT_IDLE = 5
+DEFAULT_NOTIFY_TIMEOUT = 60
+DEFAULT_PUBLISH_CHUNK = 1000
+DEFAULT_MAX_INFLIGHT = 10000
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_FLUSH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 1
+DEFAULT_STORE_RETRIES = 5
+DEFAULT_STORE_RETRY_DELAY = 1
+MAX_STORE_RETRY_DELAY = 60
+DEFAULT_ROUTE_BATCH = 1000
+DEFAULT_ROUTE_LATENCY = 1
 
 
 def _connection_info_for(db_name):
@@ -37,8 +60,26 @@ class MQTTRunner:
     and messages"""
 
     def __init__(self):
+        cfg = config.misc.get("mqtt", {})
         self.has_mqtt = self._has_mqtt()
         self.subscriptions = {}
+        # Published messages waiting for the acknowledgement of the broker
+        self.inflight = {}
+        self.acknowledged = set()
+        self.early_acknowledged = set()
+        self.inflight_lock = threading.Lock()
+        # Pipe to wake up the main loop, e.g. on acknowledgements
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+        # Received messages waiting to be stored by the writer thread
+        self.incoming = queue.Queue(int(cfg.get("queue_size", DEFAULT_QUEUE_SIZE)))
+        self.drop_on_full = cfg.get("queue_full", "block") == "drop"
+        self.writer = None
+        # Number of stored messages since the last routing
+        self.route_pending = 0
+        self.route_condition = threading.Condition()
+        self.router = None
         self.client = None
         self.connect()
         self.running = True
@@ -48,39 +89,326 @@ class MQTTRunner:
             _logger.warning("mqtt isn't installed. The client can't start")
             return
 
-        idle = config.misc.get("mqtt", {}).get("idle", DEFAULT_IDLE)
-        self.client.loop_start()
-        while self.running:
-            self.subscribe()
-            self.publish()
+        cfg = config.misc.get("mqtt", {})
+        if to_bool(cfg.get("notify", False)):
+            timeout = float(cfg.get("notify_timeout", DEFAULT_NOTIFY_TIMEOUT))
+        else:
+            timeout = None
+
+        idle = float(cfg.get("idle", DEFAULT_IDLE))
+        self.reset_sent()
+        self.writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer.start()
+        if to_bool(cfg.get("route", False)):
+            self.router = threading.Thread(target=self._router_loop, daemon=True)
+            self.router.start()
 
-            time.sleep(idle)
+        self.client.loop_start()
+        try:
+            with self.listen(timeout is not None) as conn:
+                while self.running:
+                    self.subscribe()
+                    self.publish()
+
+                    self.wait_notification(conn, timeout if conn else idle)
+        finally:
+            self.running = False
+            self.writer.join()
+            if self.router:
+                self.router.join()
 
     def stop(self):
-        self.client.loop_stop()
+        self.running = False
+        self.wake()
+        if self.client:
+            self.client.loop_stop()
+
+    def wake(self):
+        """Wake up the main loop waiting for notifications"""
+        try:
+            os.write(self.wake_write, b"\0")
+        except BlockingIOError:
+            # The pipe is full and the main loop wakes up anyway
+            pass
+
+    def _drain_wake(self):
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    @contextmanager
+    def listen(self, enabled=True):
+        """Open a dedicated connection which listens for notifications of the
+        Odoo workers about new messages or changed subscriptions"""
+        if not enabled:
+            yield None
+            return
+
+        conn = psycopg2.connect(**_connection_info_for(config["db_name"]))
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        try:
+            with conn.cursor() as cr:
+                cr.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            _logger.info("Listening for notifications on %s", NOTIFY_CHANNEL)
+            yield conn
+        finally:
+            conn.close()
+
+    def wait_notification(self, conn, timeout):
+        """Block until a notification arrives, the runner is woken up or the
+        timeout is reached. The timeout is a safety net to catch messages
+        without notification. Without connection only the wake up is waited for"""
+        if conn is None or not conn.notifies:
+            sources = [self.wake_read] if conn is None else [conn, self.wake_read]
+            ready, _, _ = select.select(sources, [], [], timeout)
+            if conn is not None and conn in ready:
+                conn.poll()
+            if self.wake_read in ready:
+                self._drain_wake()
+
+        if conn is None:
+            return set()
+
+        payloads = {notify.payload for notify in conn.notifies}
+        conn.notifies.clear()
+        return payloads
 
     def _connect_callback(self, *_args, **_kwargs):
         _logger.info("Connected to MQTT broker")
         self.subscriptions = {}
+        # Acknowledgements of the previous connection can't be matched anymore
+        # because the message IDs might be reused
+        with self.inflight_lock:
+            self.early_acknowledged.clear()
 
     def _disconnect_callback(self, *_args, **_kwargs):
         _logger.info("Disconnected from MQTT broker")
         self.subscriptions = {}
 
+    def _publish_callback(self, _client, _userdata, mid):
+        """The broker acknowledged the message. This is called from the network
+        thread of paho and might be called before `publish` returns"""
+        with self.inflight_lock:
+            msg_id = self.inflight.pop(mid, None)
+            if msg_id is None:
+                self.early_acknowledged.add(mid)
+                return
+
+            wake = not self.acknowledged
+            self.acknowledged.add(msg_id)
+
+        # Mark the acknowledged messages as processed without waiting for the
+        # next notification
+        if wake:
+            self.wake()
+
     def _message_callback(self, _client, _userdata, message):
-        with self.env() as env:
-            env["mqtt.message"].create(
-                {
-                    "direction": "incoming",
-                    "state": "enqueued",
-                    "enqueue_date": datetime.now(),
-                    "topic": message.topic,
-                    "payload": message.payload,
-                    "qos": str(message.qos),
-                    "retain": message.retain,
-                }
+        """Only buffer the message to keep the network thread of paho responsive.
+        The messages are stored in the database by the writer thread"""
+        item = (
+            datetime.now(),
+            message.topic,
+            message.payload,
+            str(message.qos),
+            bool(message.retain),
+        )
+        if not self.drop_on_full:
+            self.incoming.put(item)
+            return
+
+        try:
+            self.incoming.put_nowait(item)
+        except queue.Full:
+            _logger.warning(f"Incoming queue is full. Dropped message {message.topic}")
+
+    def _writer_loop(self):
+        """Store the received messages in batches limited by size and time"""
+        cfg = config.misc.get("mqtt", {})
+        size = int(cfg.get("flush_size", DEFAULT_FLUSH_SIZE))
+        interval = float(cfg.get("flush_interval", DEFAULT_FLUSH_INTERVAL))
+
+        while self.running or not self.incoming.empty():
+            batch = self._collect_incoming(size, interval)
+            if batch:
+                self.store_incoming_retry(batch)
+
+    def store_incoming_retry(self, batch):
+        """Store the batch and retry with an exponential backoff if it fails.
+        The broker already considers the messages as delivered. Serialization
+        failures and deadlocks are therefore retried until the batch is stored
+        and other errors until the number of retries is reached"""
+        cfg = config.misc.get("mqtt", {})
+        retries = int(cfg.get("store_retries", DEFAULT_STORE_RETRIES))
+        delay = float(cfg.get("store_retry_delay", DEFAULT_STORE_RETRY_DELAY))
+
+        failures = attempt = 0
+        while True:
+            try:
+                self.store_incoming(batch)
+                return True
+            except TransactionRollbackError:
+                _logger.warning(f"Conflict while storing {len(batch)} messages")
+            except Exception:
+                failures += 1
+                if failures > retries:
+                    _logger.exception(
+                        f"Failed to store {len(batch)} incoming messages. "
+                        "Dropping them"
+                    )
+                    return False
+
+                _logger.warning(
+                    f"Failed to store {len(batch)} incoming messages", exc_info=True
+                )
+
+            time.sleep(min(delay * 2**attempt, MAX_STORE_RETRY_DELAY))
+            attempt += 1
+
+    def _collect_incoming(self, size, interval):
+        try:
+            batch = [self.incoming.get(timeout=interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + interval
+        while len(batch) < size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(self.incoming.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _router_loop(self):
+        """Route the stored messages as soon as they arrive. Messages are
+        collected until the batch is full or the maximum latency is reached"""
+        cfg = config.misc.get("mqtt", {})
+        size = int(cfg.get("route_batch", DEFAULT_ROUTE_BATCH))
+        latency = float(cfg.get("route_latency", DEFAULT_ROUTE_LATENCY))
+
+        while self.running:
+            with self.route_condition:
+                if not self.route_condition.wait_for(
+                    lambda: self.route_pending, timeout=latency
+                ):
+                    continue
+
+                self.route_condition.wait_for(
+                    lambda: self.route_pending >= size, timeout=latency
+                )
+                self.route_pending = 0
+
+            try:
+                self.route(size)
+            except Exception:
+                _logger.exception("Routing of the MQTT messages failed")
+
+    def route(self, limit):
+        """Route the enqueued incoming messages in batches. The batches are
+        paginated by the ID and the router skips messages waiting for a retry.
+        Returns the number of routed messages"""
+        count, last_id = 0, 0
+        while True:
+            with self.env() as env:
+                messages = env["mqtt.message"]._run_mqtt_router(
+                    limit=limit, after_id=last_id
+                )
+                count += len(messages)
+                if len(messages) < limit:
+                    return count
+
+                last_id = messages[-1].id
+
+    def _wake_router(self, count):
+        with self.route_condition:
+            self.route_pending += count
+            self.route_condition.notify_all()
+
+    def flush_incoming(self):
+        """Store all buffered messages immediately"""
+        batch = []
+        while True:
+            try:
+                batch.append(self.incoming.get_nowait())
+            except queue.Empty:
+                break
+
+        self.store_incoming(batch)
+
+    def _get_payload_compression(self, cr):
+        """Read the compression of the payloads from the system parameters"""
+        cr.execute(
+            """
+            SELECT key, value FROM ir_config_parameter
+            WHERE key IN ('mqtt.payload_compression', 'mqtt.payload_threshold')
+            """
+        )
+        params = dict(cr.fetchall())
+        return get_compression(params.get)
+
+    def _encoding_of(self, payload):
+        """Payloads which are valid UTF-8 are text and everything else is
+        stored as binary payload"""
+        if not isinstance(payload, bytes):
+            return "text"
+
+        try:
+            payload.decode("utf-8")
+            return "text"
+        except UnicodeDecodeError:
+            return "binary"
+
+    def store_incoming(self, batch):
+        """Insert the received messages with a single statement"""
+        if not batch:
+            return
+
+        with self.cursor() as cr:
+            codec, threshold = self._get_payload_compression(cr)
+
+            # Intern the topics of the batch at once
+            topic_ids = intern_topics(cr, {topic for _date, topic, *_rest in batch})
+
+            rows = []
+            for date, topic, payload, qos, retain in batch:
+                data, data_codec, size, encoding = pack_payload(
+                    payload, codec, threshold, encoding=self._encoding_of(payload)
+                )
+                if data is not None:
+                    data = psycopg2.Binary(data)
+
+                date = fields.Datetime.to_string(date)
+                topic_id = topic_ids.get(topic)
+                rows.append(
+                    (topic_id, data, data_codec, size, encoding, qos, retain, date)
+                )
+
+            execute_values(
+                cr._obj,
+                """
+                INSERT INTO mqtt_message (
+                    topic_id, payload_data, payload_codec, payload_size,
+                    payload_encoding, qos, retain, enqueue_date, direction, state,
+                    create_uid, create_date, write_uid, write_date
+                ) VALUES %s
+                """,
+                rows,
+                template=f"""(
+                    %s, %s, %s, %s, %s, %s, %s, %s, 'incoming', 'enqueued',
+                    {odoo.SUPERUSER_ID}, (now() at time zone 'UTC'),
+                    {odoo.SUPERUSER_ID}, (now() at time zone 'UTC')
+                )""",
+                page_size=len(rows),
             )
 
+        self._wake_router(len(rows))
+
     def connect(self):
         """Connect to the MQTT broker"""
         cfg = config.misc.get("mqtt", {})
@@ -97,6 +425,7 @@ class MQTTRunner:
         self.client = mqtt.Client(client_id=self.client_id, clean_session=False)
 
         self.client.on_message = self._message_callback
+        self.client.on_publish = self._publish_callback
         self.client.on_connect = self._connect_callback
         self.client.on_disconnect = self._disconnect_callback
 
@@ -126,37 +455,99 @@ class MQTTRunner:
         return True
 
     def publish(self):
-        """Publish new messages on the bus"""
+        """Publish new messages on the bus. The messages are fetched in chunks
+        ordered by the enqueue date and the number of messages waiting for the
+        acknowledgement of the broker is limited"""
+        self.flush_acknowledged()
+
+        cfg = config.misc.get("mqtt", {})
+        chunk = int(cfg.get("publish_chunk", DEFAULT_PUBLISH_CHUNK))
+        max_inflight = int(cfg.get("max_inflight", DEFAULT_MAX_INFLIGHT))
+
+        while True:
+            with self.inflight_lock:
+                limit = min(chunk, max_inflight - len(self.inflight))
+
+            if limit <= 0:
+                return
+
+            with self.cursor() as cr:
+                cr.execute(
+                    """
+                    SELECT m.id, t.topic, m.payload_data, m.payload_codec, m.qos,
+                        m.retain
+                    FROM mqtt_message m LEFT JOIN mqtt_topic t ON t.id = m.topic_id
+                    WHERE m.state = 'enqueued' AND m.direction = 'outgoing'
+                    ORDER BY m.enqueue_date, m.id
+                    LIMIT %s
+                    """,
+                    (limit,),
+                )
+                messages = list(cr.fetchall())
+
+            sent = []
+            for msg_id, topic, data, codec, qos, retain in messages:
+                qos = int(qos or 0)
+                payload = unpack_payload(data, codec) or None
+
+                result = self.client.publish(
+                    topic, payload=payload, qos=qos, retain=retain
+                )
+                # Without connection paho still queues messages with QoS > 0
+                # and sends them after reconnecting
+                queued = qos > 0 and result.rc == mqtt.MQTT_ERR_NO_CONN
+                if result.rc != mqtt.MQTT_ERR_SUCCESS and not queued:
+                    break
+
+                sent.append(msg_id)
+                with self.inflight_lock:
+                    if result.mid in self.early_acknowledged:
+                        self.early_acknowledged.discard(result.mid)
+                        self.acknowledged.add(msg_id)
+                    else:
+                        self.inflight[result.mid] = msg_id
+
+            self._set_state(sent, "sent")
+            if len(sent) < limit:
+                return
+
+    def flush_acknowledged(self):
+        """Mark the acknowledged messages as processed"""
+        with self.inflight_lock:
+            acknowledged, self.acknowledged = self.acknowledged, set()
+
+        self._set_state(acknowledged, "processed")
+
+    def reset_sent(self):
+        """Messages which weren't acknowledged before a restart must be sent
+        again because the queue of the previous client is lost"""
         with self.cursor() as cr:
             cr.execute(
                 """
-                SELECT id, topic, payload, qos, retain FROM mqtt_message
-                WHERE state = 'enqueued' AND direction = 'outgoing'
+                UPDATE mqtt_message SET state = 'enqueued'
+                WHERE state = 'sent' AND direction = 'outgoing'
                 """
             )
-            messages = list(cr.fetchall())
-
-        published = []
-        for mid, topic, payload, qos, retain in messages:
-            qos = int(qos or 0)
-
-            result = self.client.publish(topic, payload=payload, qos=qos, retain=retain)
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                published.append(mid)
 
-        if not published:
+    def _set_state(self, ids, state):
+        if not ids:
             return
 
-        now = datetime.now()
+        now = fields.Datetime.to_string(datetime.now())
         with self.cursor() as cr:
-            cr.execute(
-                """
-                UPDATE mqtt_message
-                SET state = 'processed', process_date = %s
-                WHERE id IN %s
-                """,
-                (fields.Datetime.to_string(now), tuple(published)),
-            )
+            if state == "processed":
+                cr.execute(
+                    """
+                    UPDATE mqtt_message SET state = %s, process_date = %s
+                    WHERE id IN %s
+                    """,
+                    (state, now, tuple(ids)),
+                )
+            else:
+                cr.execute(
+                    "UPDATE mqtt_message SET state = %s WHERE id IN %s",
+                    (state, tuple(ids)),
+                )
 
     def subscribe(self):
         """Handle the subscription for new topics and unsubscribe old ones"""
@@ -190,8 +581,18 @@ class MQTTRunner:
 
     @contextmanager
     def cursor(self):
-        with odoo.registry(config["db_name"]).cursor() as cr:
-            yield cr
+        """Open a cursor of the registry. Invalidations of the other workers,
+        e.g. of the subscribers or a reloaded registry, are applied before and
+        the own invalidations are signaled afterwards"""
+        registry = odoo.registry(config["db_name"]).check_signaling()
+        try:
+            with registry.cursor() as cr:
+                yield cr
+        except Exception:
+            registry.reset_changes()
+            raise
+
+        registry.signal_changes()
 
     @contextmanager
     def env(self):
@@ -0,0 +1,77 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import threading
+from collections import OrderedDict
+
+from psycopg2 import OperationalError
+from werkzeug.exceptions import HTTPException
+
+from odoo import http
+from odoo.exceptions import RedirectWarning, UserError
+from odoo.tools import safe_eval
+
+# Maximum number of compiled snippets kept per worker
+CACHE_SIZE = 512
+
+
+class SnippetCache:
+    """Size bounded cache of the checked and compiled python snippets. The
+    entries are keyed by the record, the field and the source of the snippet
+    which compiles changed snippets again"""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def compile(self, record, fname, mode="exec"):
+        """Returns the compiled code of the field. The opcodes are checked by
+        `test_expr` like `safe_eval` does"""
+        code = record[fname] or ""
+        key = (record.env.cr.dbname, record._name, record.id, fname, mode, code)
+        with self.lock:
+            compiled = self.data.get(key)
+            if compiled is not None:
+                self.data.move_to_end(key)
+                return compiled
+
+        compiled = safe_eval.test_expr(code, safe_eval._SAFE_OPCODES, mode=mode)
+        with self.lock:
+            self.data[key] = compiled
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+        return compiled
+
+    def run(self, record, fname, context, mode="exec"):
+        """Execute the code of the field within the context with the same
+        restrictions as `safe_eval`. The context is modified in place"""
+        compiled = self.compile(record, fname, mode=mode)
+
+        safe_eval.check_values(context)
+        context["__builtins__"] = safe_eval._BUILTINS
+        try:
+            return safe_eval.unsafe_eval(compiled, context)
+        except (
+            UserError,
+            RedirectWarning,
+            HTTPException,
+            http.AuthenticationError,
+            OperationalError,
+            ZeroDivisionError,
+        ):
+            raise
+        except Exception as e:
+            raise ValueError(
+                f'{type(e)}: "{e}" while evaluating\n{record[fname]!r}'
+            ) from e
+
+
+snippets = SnippetCache()
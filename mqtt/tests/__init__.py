@@ -1,4 +1,12 @@
 # © 2022 Florian Kantelberg - initOS GmbH
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from . import test_client, test_config, test_event, test_message, test_processor
+from . import (
+    test_base,
+    test_client,
+    test_config,
+    test_event,
+    test_message,
+    test_processor,
+    test_topic,
+)
@@ -2,7 +2,9 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 from datetime import date, datetime
+from unittest.mock import patch
 
+from odoo.exceptions import ValidationError
 from odoo.tests import TransactionCase
 
 
@@ -48,10 +50,15 @@ class TestBase(TransactionCase):
             }
         )
 
+    def count_messages(self):
+        # Events are published right before the commit
+        self.env.cr.precommit.run()
+        return self.env["mqtt.message"].search_count([])
+
     def test_event_create(self):
         before = self.env["mqtt.message"].search_count([])
         self.partner.create({"name": "Test"})
-        after = self.env["mqtt.message"].search_count([])
+        after = self.count_messages()
         self.assertTrue(after > before)
 
     def test_event_create_deleted(self):
@@ -60,14 +67,14 @@ class TestBase(TransactionCase):
         self.env["ir.model.data"].search(domain).unlink()
         before = self.env["mqtt.message"].search_count([])
         self.partner.create({"name": "Test"})
-        after = self.env["mqtt.message"].search_count([])
+        after = self.count_messages()
         self.assertEqual(after, before)
 
     def test_event_delete(self):
         p = self.partner.create({"name": "Test"})
-        before = self.env["mqtt.message"].search_count([])
+        before = self.count_messages()
         p.unlink()
-        after = self.env["mqtt.message"].search_count([])
+        after = self.count_messages()
         self.assertTrue(after > before)
 
     def test_event_delete_deleted(self):
@@ -75,15 +82,15 @@ class TestBase(TransactionCase):
         p = self.partner.create({"name": "Test"})
         domain = [("name", "=", "type_delete"), ("module", "=", "mqtt")]
         self.env["ir.model.data"].search(domain).unlink()
-        before = self.env["mqtt.message"].search_count([])
+        before = self.count_messages()
         p.unlink()
-        after = self.env["mqtt.message"].search_count([])
+        after = self.count_messages()
         self.assertEqual(after, before)
 
     def test_event_write(self):
         before = self.env["mqtt.message"].search_count([])
         self.partner.write({"name": "Test"})
-        after = self.env["mqtt.message"].search_count([])
+        after = self.count_messages()
         self.assertTrue(after > before)
 
     def test_event_write_deleted(self):
@@ -92,9 +99,113 @@ class TestBase(TransactionCase):
         self.env["ir.model.data"].search(domain).unlink()
         before = self.env["mqtt.message"].search_count([])
         self.partner.write({"name": "Test"})
-        after = self.env["mqtt.message"].search_count([])
+        after = self.count_messages()
         self.assertEqual(after, before)
 
+    def test_event_coalesce_write(self):
+        before = self.count_messages()
+        self.partner.write({"name": "Test"})
+        self.partner.write({"name": "Test 2"})
+        self.assertEqual(self.env["mqtt.message"].search_count([]), before)
+        self.assertEqual(self.count_messages(), before + 1)
+
+        msg = self.env["mqtt.message"].search([], order="id DESC", limit=1)
+        self.assertEqual(msg.topic, "odoo/partner/write")
+        self.assertEqual(msg.json()[0]["name"], "Test 2")
+
+    def test_event_coalesce_create(self):
+        before = self.count_messages()
+
+        # Create and write are collapsed into the create event
+        p = self.partner.create({"name": "Test"})
+        p.write({"name": "Test 2"})
+        self.assertEqual(self.count_messages(), before + 1)
+        msg = self.env["mqtt.message"].search([], order="id DESC", limit=1)
+        self.assertEqual(msg.topic, "odoo/partner/create")
+        self.assertEqual(msg.json()[0]["name"], "Test 2")
+
+        # Create and unlink are dropped
+        p = self.partner.create({"name": "Test"})
+        p.write({"name": "Test 2"})
+        p.unlink()
+        self.assertEqual(self.count_messages(), before + 1)
+
+    def test_event_env(self):
+        user = self.env["res.users"].create(
+            {
+                "login": "mqtt_event_user",
+                "name": "MQTT Event User",
+                "groups_id": [
+                    (4, self.env.ref("base.group_user").id),
+                    (4, self.env.ref("base.group_partner_manager").id),
+                ],
+            }
+        )
+        partner = self.partner.with_user(user).with_context(mqtt_testing=True)
+        partner.write({"name": "Test"})
+        self.partner.write({"name": "Test 2"})
+
+        # The payloads are generated in the environment of the change
+        model = type(self.partner)
+        with patch.object(
+            model,
+            "_mqtt_event_messages",
+            autospec=True,
+            side_effect=model._mqtt_event_messages,
+        ) as mock:
+            self.env.cr.precommit.run()
+
+        envs = [call.args[0].env for call in mock.call_args_list]
+        self.assertEqual([env.uid for env in envs], [user.id, self.env.uid])
+        self.assertTrue(envs[0].context.get("mqtt_testing"))
+        self.assertFalse(envs[0].su)
+        self.assertFalse(envs[1].context.get("mqtt_testing"))
+
+    def test_event_rollback(self):
+        before = self.count_messages()
+        self.partner.write({"name": "Test"})
+        self.env.cr.precommit.clear()
+        self.assertEqual(self.count_messages(), before)
+
+    def test_event_split(self):
+        self.create_event.split_mode = "record"
+        partners = self.partner.create([{"name": f"Test {i}"} for i in range(5)])
+        self.count_messages()
+
+        messages = self.env["mqtt.message"].search([], order="id DESC", limit=5)
+        self.assertEqual(len(messages), 5)
+        self.assertEqual(
+            sorted(msg.json()["id"] for msg in messages), sorted(partners.ids)
+        )
+
+        self.create_event.write({"split_mode": "chunk", "chunk_size": 2})
+        before = self.count_messages()
+        partners = self.partner.create([{"name": f"Test {i}"} for i in range(5)])
+        self.assertEqual(self.count_messages(), before + 3)
+
+        messages = self.env["mqtt.message"].search([], order="id DESC", limit=3)
+        self.assertEqual(sorted(len(msg.json()) for msg in messages), [1, 2, 2])
+
+        with self.assertRaises(ValidationError):
+            self.create_event.chunk_size = 0
+
+    def test_event_cache(self):
+        descriptors = self.partner._mqtt_events("mqtt.type_write")
+        self.assertEqual(len(descriptors), 1)
+        self.assertEqual(descriptors[0].event_id, self.write_event.id)
+        self.assertEqual(descriptors[0].topic, "odoo/partner/write")
+        self.assertEqual(descriptors[0].fields, frozenset(["name"]))
+        self.assertIs(descriptors, self.partner._mqtt_events("mqtt.type_write"))
+
+        # Changing the event invalidates the cache
+        self.write_event.topic = "odoo/partner/changed"
+        descriptors = self.partner._mqtt_events("mqtt.type_write")
+        self.assertEqual(descriptors[0].topic, "odoo/partner/changed")
+
+        self.write_event.active = False
+        self.assertFalse(self.partner._mqtt_events("mqtt.type_write"))
+        self.assertFalse(self.partner._mqtt_events("mqtt.type_unknown"))
+
     def test_publish(self):
         self.env["mqtt.message"].search([]).unlink()
         data = {"i": 0, "f": 0.5, "d": date(2022, 2, 2), "dt": datetime(2022, 2, 2)}
@@ -1,13 +1,17 @@
 # © 2022 Florian Kantelberg - initOS GmbH
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from unittest.mock import MagicMock
+import queue
+import select
+from unittest.mock import MagicMock, patch
 
-from odoo import api
+from psycopg2.extensions import TransactionRollbackError
+
+from odoo import api, fields
 from odoo.tests import TransactionCase
 from odoo.tools import config
 
-from ..runner.client import MQTTRunner, to_bool
+from ..runner.client import MQTTRunner, mqtt, to_bool
 
 
 class TestClient(TransactionCase):
@@ -49,6 +53,10 @@ class TestClient(TransactionCase):
                 retain=False,
             ),
         )
+        self.assertEqual(self.runner.incoming.qsize(), 1)
+        self.runner.flush_incoming()
+        self.assertTrue(self.runner.incoming.empty())
+        self.assertEqual(self.runner.route_pending, 1)
         after = self.env["mqtt.message"].search_count([])
         self.assertTrue(after > before)
 
@@ -60,10 +68,110 @@ class TestClient(TransactionCase):
         self.runner._disconnect_callback()
         self.assertFalse(self.runner.subscriptions)
 
+    def test_callback_queue_full(self):
+        self.runner.incoming = queue.Queue(1)
+        self.runner.drop_on_full = True
+        for _i in range(2):
+            self.runner._message_callback(
+                None,
+                None,
+                MagicMock(topic="odoo/testing", payload=b"\xff", qos=0, retain=True),
+            )
+
+        self.assertEqual(self.runner.incoming.qsize(), 1)
+        self.runner.flush_incoming()
+
+        msg = self.env["mqtt.message"].search([], order="id DESC", limit=1)
+        self.assertEqual(msg.topic, "odoo/testing")
+        self.assertEqual(msg.direction, "incoming")
+        self.assertEqual(msg.state, "enqueued")
+        self.assertTrue(msg.retain)
+
+        # Invalid UTF-8 payloads are kept intact
+        self.assertEqual(msg.payload_encoding, "binary")
+        self.assertEqual(msg.payload_size, 1)
+        self.assertEqual(msg.get_payload(), b"\xff")
+
+    def test_store_retry(self):
+        batch = [(None, "odoo/testing", b"", "0", False)]
+        conflict = TransactionRollbackError("could not serialize access")
+        with patch.object(self.runner, "store_incoming") as store, patch(
+            "time.sleep"
+        ) as sleep:
+            # Conflicts are retried until the batch is stored
+            store.side_effect = [conflict] * 10 + [None]
+            self.assertTrue(self.runner.store_incoming_retry(batch))
+            self.assertEqual(store.call_count, 11)
+            self.assertEqual(sleep.call_count, 10)
+
+            # Other errors are retried a limited number of times
+            store.reset_mock(side_effect=True)
+            store.side_effect = ValueError()
+            cfg = {"store_retries": 2, "store_retry_delay": 0}
+            with patch.dict(config.misc, {"mqtt": cfg}):
+                self.assertFalse(self.runner.store_incoming_retry(batch))
+            self.assertEqual(store.call_count, 3)
+
+    def test_cursor_signaling(self):
+        registry = MagicMock()
+        registry.check_signaling.return_value = registry
+        with patch("odoo.registry", return_value=registry):
+            with MQTTRunner.cursor(self.runner):
+                registry.check_signaling.assert_called_once()
+            registry.signal_changes.assert_called_once()
+
+            with self.assertRaises(ValueError):
+                with MQTTRunner.cursor(self.runner):
+                    raise ValueError()
+            registry.reset_changes.assert_called_once()
+            registry.signal_changes.assert_called_once()
+
+    def test_route_reloaded_registry(self):
+        self.env.cr.commit = MagicMock()
+        self.env.cr.rollback = MagicMock()
+
+        # Another worker installed a module and the registry is reloaded
+        old, new = MagicMock(), MagicMock()
+        old.check_signaling.return_value = new
+        new.check_signaling.return_value = new
+        new.cursor.return_value.__enter__.return_value = self.env.cr
+        new.cursor.return_value.__exit__.return_value = False
+
+        del self.runner.cursor
+        with patch("odoo.registry", return_value=old):
+            self.runner.route(10)
+
+        new.cursor.assert_called()
+        old.cursor.assert_not_called()
+
+    def test_route(self):
+        self.env.cr.commit = MagicMock()
+        self.env.cr.rollback = MagicMock()
+        messages = self.env["mqtt.message"].create(
+            [
+                {"topic": "odoo/testing", "direction": "incoming", "state": "enqueued"}
+                for _i in range(2)
+            ]
+        )
+
+        # One page per message and an empty page ends the routing
+        model = type(messages)
+        router = model._run_mqtt_router
+        with patch.object(
+            model, "_run_mqtt_router", autospec=True, side_effect=router
+        ) as mock:
+            self.assertEqual(self.runner.route(1), 2)
+
+        pages = [call.kwargs["after_id"] for call in mock.call_args_list]
+        self.assertEqual(pages, [0, *messages.sorted("id").ids])
+        self.assertEqual(set(messages.mapped("state")), {"processed"})
+        self.assertEqual(self.runner.route(1), 0)
+
     def test_publish(self):
         self.runner.client = MagicMock()
         mock = self.runner.client.publish = MagicMock()
         mock.return_value.rc = 0
+        mock.return_value.mid = 1
 
         msg = self.env["mqtt.message"].create(
             {
@@ -75,6 +183,22 @@ class TestClient(TransactionCase):
         )
 
         msg.flush()
+        self.runner.publish()
+        mock.assert_called_once_with(
+            "odoo/testing", payload=b"testing payload", qos=0, retain=False
+        )
+        self.assertEqual(self.runner.inflight, {1: msg.id})
+
+        self.env.cr.execute(
+            "SELECT 1 FROM mqtt_message WHERE id = %s AND state = 'sent'",
+            (msg.id,),
+        )
+        self.assertTrue(self.env.cr.fetchone())
+
+        # The broker acknowledges the message
+        self.runner._publish_callback(None, None, 1)
+        self.assertFalse(self.runner.inflight)
+
         self.runner.publish()
         mock.assert_called_once()
 
@@ -84,8 +208,111 @@ class TestClient(TransactionCase):
         )
         self.assertTrue(self.env.cr.fetchone())
 
+    def test_publish_inflight(self):
+        self.runner.client = MagicMock()
+        mock = self.runner.client.publish = MagicMock(
+            side_effect=[MagicMock(rc=0, mid=mid) for mid in (1, 2, 3)]
+        )
+
+        messages = self.env["mqtt.message"].create(
+            [
+                {
+                    "state": "enqueued",
+                    "direction": "outgoing",
+                    "topic": f"odoo/testing/{i}",
+                    "payload": "testing payload",
+                }
+                for i in range(3)
+            ]
+        )
+        messages.flush()
+
+        # Acknowledgement before publish returns
+        self.runner._publish_callback(None, None, 1)
+
+        cfg = {"publish_chunk": 1, "max_inflight": 2}
+        with patch.dict(config.misc, {"mqtt": cfg}):
+            self.runner.publish()
+
+        self.assertEqual(mock.call_count, 3)
+        self.assertEqual(len(self.runner.acknowledged), 1)
+
+        self.runner.reset_sent()
+        self.env.cr.execute(
+            "SELECT COUNT(*) FROM mqtt_message WHERE id IN %s AND state = 'sent'",
+            (tuple(messages.ids),),
+        )
+        self.assertEqual(self.env.cr.fetchone()[0], 0)
+
+    def test_publish_queued(self):
+        self.runner.client = MagicMock()
+        mock = self.runner.client.publish = MagicMock()
+        mock.return_value.rc = mqtt.MQTT_ERR_NO_CONN
+        mock.return_value.mid = 7
+
+        messages = self.env["mqtt.message"].create(
+            [
+                {
+                    "state": "enqueued",
+                    "direction": "outgoing",
+                    "topic": "odoo/testing",
+                    "qos": qos,
+                    "enqueue_date": fields.Datetime.now(),
+                }
+                for qos in ("1", "0")
+            ]
+        )
+        messages.flush()
+
+        # The message with QoS 1 is queued by paho and waits for the broker
         self.runner.publish()
-        mock.assert_called_once()
+        self.assertEqual(mock.call_count, 2)
+        self.assertEqual(self.runner.inflight, {7: messages[0].id})
+        self.env.cr.execute(
+            "SELECT id FROM mqtt_message WHERE id IN %s AND state = 'sent'",
+            (tuple(messages.ids),),
+        )
+        self.assertEqual([row[0] for row in self.env.cr.fetchall()], messages[:1].ids)
+
+    def test_acknowledge(self):
+        # Unknown acknowledgements are dropped on reconnect
+        self.runner._publish_callback(None, None, 5)
+        self.assertEqual(self.runner.early_acknowledged, {5})
+        self.runner._connect_callback()
+        self.assertFalse(self.runner.early_acknowledged)
+
+        # Acknowledgements wake up the main loop
+        self.runner.inflight[6] = 42
+        self.runner._publish_callback(None, None, 6)
+        self.assertEqual(self.runner.acknowledged, {42})
+        ready, _, _ = select.select([self.runner.wake_read], [], [], 0)
+        self.assertTrue(ready)
+        self.assertEqual(self.runner.wait_notification(None, 0), set())
+        ready, _, _ = select.select([self.runner.wake_read], [], [], 0)
+        self.assertFalse(ready)
+
+    def test_notify(self):
+        messages = self.env["mqtt.message"]
+        with patch.object(type(messages), "_notify_runner") as mock:
+            msg = messages.create({"direction": "outgoing", "topic": "odoo/testing"})
+            mock.assert_not_called()
+
+            msg.action_enqueue()
+            mock.assert_called_once_with("publish")
+
+        subscriptions = self.env["mqtt.subscription"]
+        with patch.object(type(subscriptions), "_notify_runner") as mock:
+            subscriptions.create({"topic": "odoo/testing/#"})
+            mock.assert_called_once_with("subscribe")
+
+    def test_wait_notification(self):
+        conn = MagicMock(notifies=[MagicMock(payload="publish")])
+        self.assertEqual(self.runner.wait_notification(conn, 0), {"publish"})
+        self.assertFalse(conn.notifies)
+
+        with patch("select.select", return_value=([conn], [], [])):
+            self.assertEqual(self.runner.wait_notification(conn, 0), set())
+            conn.poll.assert_called_once()
 
     def test_subscription(self):
         ret = 0, None
@@ -1,6 +1,7 @@
 # © 2022 Florian Kantelberg - initOS GmbH
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+from odoo.exceptions import ValidationError
 from odoo.tests import TransactionCase
 
 
@@ -14,10 +15,12 @@ class TestConfig(TransactionCase):
 
         icp.set_param("mqtt.message_vacuum", "")
         icp.set_param("mqtt.message_vacuum_hours", "a")
+        icp.set_param("mqtt.router_workers", "a")
         vals = self.config.get_values()
         self.assertFalse(vals["mqtt_gc_incoming"])
         self.assertFalse(vals["mqtt_gc_outgoing"])
         self.assertEqual(vals["mqtt_gc_hours"], 12)
+        self.assertEqual(vals["mqtt_router_workers"], 1)
 
         icp.set_param("mqtt.message_vacuum", "incoming,outgoing")
         icp.set_param("mqtt.message_vacuum_hours", "15")
@@ -32,10 +35,36 @@ class TestConfig(TransactionCase):
                 "mqtt_gc_incoming": True,
                 "mqtt_gc_outgoing": True,
                 "mqtt_gc_hours": 42,
+                "mqtt_router_workers": 4,
+                "mqtt_router_partition": "topic",
+                "mqtt_router_retry_delay": 30,
+                "mqtt_router_max_attempts": 3,
+                "mqtt_payload_compression": "lzma",
+                "mqtt_payload_threshold": 512,
             }
         )
         self.config.set_values()
         vals = self.config.get_values()
+        self.assertEqual(vals["mqtt_router_retry_delay"], 30)
+        self.assertEqual(vals["mqtt_router_max_attempts"], 3)
+        self.assertEqual(vals["mqtt_payload_compression"], "lzma")
+        self.assertEqual(vals["mqtt_payload_threshold"], 512)
+        self.assertEqual(vals["mqtt_router_workers"], 4)
+        self.assertEqual(vals["mqtt_router_partition"], "topic")
         self.assertTrue(vals["mqtt_gc_incoming"])
         self.assertTrue(vals["mqtt_gc_outgoing"])
         self.assertEqual(vals["mqtt_gc_hours"], 42)
+
+    def test_set_config_zero(self):
+        self.config.write({"mqtt_router_retry_delay": 0, "mqtt_payload_threshold": 0})
+        self.config.set_values()
+        vals = self.config.get_values()
+        self.assertEqual(vals["mqtt_router_retry_delay"], 0)
+        self.assertEqual(vals["mqtt_payload_threshold"], 0)
+
+        with self.assertRaises(ValidationError):
+            self.config.write({"mqtt_router_retry_delay": -1})
+        with self.assertRaises(ValidationError):
+            self.config.write({"mqtt_router_max_attempts": 0})
+        with self.assertRaises(ValidationError):
+            self.config.write({"mqtt_payload_threshold": -1})
@@ -1,6 +1,9 @@
 # © 2022 Florian Kantelberg - initOS GmbH
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+from unittest.mock import patch
+
+from odoo import models
 from odoo.exceptions import ValidationError
 from odoo.tests import TransactionCase
 
@@ -23,6 +26,30 @@ class TestEvent(TransactionCase):
         with self.assertRaises(ValidationError):
             self.event._onchange_topic()
 
+    def test_topic_placeholders(self):
+        etype = self.env.ref("mqtt.type_write")
+        client_id = self.env["ir.config_parameter"]._get_mqtt_client_id()
+        self.event.topic = "odoo/{code}/{client}/{company_id}"
+        self.assertEqual(
+            self.event.convert_topic(etype),
+            f"odoo/{etype.code}/{client_id}/{{company_id}}",
+        )
+
+        with self.assertRaises(ValidationError):
+            self.event.topic = "odoo/{invalid_field}"
+
+    def test_topic_per_record(self):
+        self.event.write({"active": True, "topic": "odoo/partner/{id}"})
+        partners = self.env["res.partner"].create([{"name": "a"}, {"name": "b"}])
+        descriptors = partners._mqtt_events("mqtt.type_write")
+        self.assertEqual(descriptors[0].topic_fields, ("id",))
+
+        groups = partners._mqtt_group_by_topic(descriptors[0])
+        self.assertEqual(
+            groups,
+            {f"odoo/partner/{p.id}": p for p in partners},
+        )
+
     def test_blacklisting(self):
         self.event._onchange_model()
 
@@ -34,6 +61,18 @@ class TestEvent(TransactionCase):
         self.assertIn("records", self.event._get_default_code())
         self.assertIn("<code>records</code>", self.event.help_text)
 
+    def test_descriptor_cache(self):
+        etype = self.env.ref("mqtt.type_write")
+        with patch.object(models.BaseModel, "clear_caches") as mock:
+            self.assertTrue(self.event.help_text)
+            self.event.write({"code": "result = 1"})
+            etype.write({"name": "Changed"})
+            mock.assert_not_called()
+
+            self.event.write({"topic": "odoo/partner/changed"})
+            etype.write({"code": "changed"})
+            self.assertEqual(mock.call_count, 2)
+
     def test_events_active(self):
         with self.assertRaises(ValidationError):
             self.event.write({"active": True, "type_ids": [(6, 0, [])]})
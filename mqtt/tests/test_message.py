@@ -2,12 +2,23 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import json
-from unittest.mock import MagicMock
+from unittest import skipIf
+from unittest.mock import MagicMock, patch
 
-from odoo import api, models
+from odoo import api, models, tools
 from odoo.exceptions import AccessDenied, ValidationError
 from odoo.tests import TransactionCase
 
+from ..formats import cbor2, msgpack
+from ..models.mqtt_message import ROUTER_LOCK
+from ..payload import (
+    DEFAULT_CODEC,
+    DEFAULT_THRESHOLD,
+    get_compression,
+    pack_payload,
+    unpack_payload,
+)
+
 
 class ResPartner(models.Model):
     _inherit = "res.partner"
@@ -54,6 +65,17 @@ class TestMessage(TransactionCase):
         self.topic_test(self.messages.browse(), "#", 0)
         self.topic_test(self.messages, "testing/#a", 0)
 
+    def test_mqtt_handlers(self):
+        handlers = self.messages._get_mqtt_handlers()
+        self.assertIs(handlers, self.messages._get_mqtt_handlers())
+
+        functions = list(self.messages._mqtt_functions())
+        self.assertEqual(len(functions), len(handlers))
+        for handler, (model, attr, func) in zip(handlers, functions):
+            self.assertEqual(model._name, handler.model)
+            self.assertEqual(attr, handler.method)
+            self.assertEqual(func._mqtt, handler.topic)
+
     def test_lock(self):
         msg = self.messages[0]
         msg.with_context(mqtt_lock=True).topic = "testing/invalid"
@@ -101,6 +123,7 @@ class TestMessage(TransactionCase):
         self.assertEqual(msg.subscriber, 2)
 
     def test_gc(self):
+        self.messages.env.cr.commit = MagicMock()
         icp = self.env["ir.config_parameter"].sudo()
         icp.set_param("mqtt.message_vacuum", "")
         icp.set_param("mqtt.message_vacuum_hours", "a")
@@ -117,8 +140,16 @@ class TestMessage(TransactionCase):
 
         self.messages.write({"state": "processed"})
         icp.set_param("mqtt.message_vacuum_hours", "0")
+        icp.set_param("mqtt.message_vacuum_chunk", "1")
         self.messages._gc_messages()
         self.assertEqual(len(self.messages.exists()), 1)
+        self.assertGreaterEqual(self.messages.env.cr.commit.call_count, 3)
+
+        # An invalid chunk size deletes one message at a time
+        msg = self.messages.create({"topic": "testing/gc", "state": "processed"})
+        icp.set_param("mqtt.message_vacuum_chunk", "0")
+        self.messages._gc_messages()
+        self.assertFalse(msg.exists())
 
     def test_mqtt_router(self):
         user = self.env["res.users"].create(
@@ -133,9 +164,173 @@ class TestMessage(TransactionCase):
         self.messages.write({"state": "enqueued", "direction": "incoming"})
         self.messages._run_mqtt_router()
 
-        self.messages.env.cr.commit.assert_called_once()
+        # The failed delivery is stored after the rollback
+        self.assertEqual(self.messages.env.cr.commit.call_count, 2)
         self.messages.env.cr.rollback.assert_called_once()
 
+        msg = self.messages[0]
+        self.assertEqual(msg.state, "enqueued")
+        self.assertEqual(sorted(msg.delivery_ids.mapped("state")), ["done", "failed"])
+
+        # Only the failed delivery is retried
+        self.messages._run_mqtt_router()
+        self.assertEqual(self.messages.env.cr.commit.call_count, 3)
+        self.assertEqual(self.messages.env.cr.rollback.call_count, 2)
+        failed = msg.delivery_ids.filtered(lambda d: d.state == "failed")
+        self.assertEqual(failed.attempts, 2)
+        self.assertIn("AccessDenied", failed.error)
+
+    def test_mqtt_router_unsubscribed(self):
+        self.messages.env.cr.commit = MagicMock()
+        self.messages.env.cr.rollback = MagicMock()
+        self.messages.write({"state": "enqueued", "direction": "incoming"})
+
+        # Nobody subscribed to the topic of the last message
+        msg = self.messages[3]
+        self.messages._run_mqtt_router()
+        self.assertEqual(msg.state, "processed")
+        self.assertTrue(msg.process_date)
+        self.assertFalse(msg.delivery_ids)
+        self.assertEqual(self.messages[0].state, "enqueued")
+
+    def test_mqtt_router_limit(self):
+        self.messages.env.cr.commit = MagicMock()
+        self.messages.env.cr.rollback = MagicMock()
+        self.messages.write({"state": "enqueued", "direction": "incoming"})
+        routed = self.messages._run_mqtt_router(limit=1)
+        self.assertEqual(routed, self.messages[0])
+        routed = self.messages._run_mqtt_router(limit=2, after_id=routed.id)
+        self.assertEqual(routed, self.messages[1:3])
+
+        # Another router holds the lock
+        with self.registry.cursor() as cr:
+            cr.execute("SELECT pg_advisory_xact_lock(%s)", (ROUTER_LOCK,))
+            self.assertFalse(self.messages._run_mqtt_router())
+            cr.rollback()
+
+    def test_mqtt_router_lock_lost(self):
+        self.messages.env.cr.commit = MagicMock()
+        self.messages.env.cr.rollback = MagicMock()
+        self.messages.write({"state": "enqueued", "direction": "incoming"})
+
+        # Another router takes the lock after the first commit
+        model = type(self.messages)
+        with patch.object(model, "_try_router_lock", side_effect=[True, False]):
+            self.assertFalse(self.messages._run_mqtt_router())
+
+        # Routing stops after the first delivery
+        cr = self.messages.env.cr
+        self.assertEqual(cr.commit.call_count + cr.rollback.call_count, 1)
+        self.assertEqual(set(self.messages.mapped("state")), {"enqueued"})
+
+    def test_mqtt_router_dead_letter(self):
+        self.messages.env.cr.commit = MagicMock()
+        self.messages.env.cr.rollback = MagicMock()
+        proc = self._create_processor()
+        proc.write(
+            {
+                "topic": "proc/#",
+                "code": "if 'proc/poison' in messages.mapped('topic'):\n"
+                "    raise UserError('poison')",
+            }
+        )
+        self.messages.write(
+            {"state": "enqueued", "direction": "incoming", "topic": "proc/abc"}
+        )
+        poison = self.messages[1]
+        poison.topic = "proc/poison"
+
+        icp = self.env["ir.config_parameter"].sudo()
+        icp.set_param("mqtt.router_max_attempts", "2")
+        icp.set_param("mqtt.router_retry_delay", "0")
+
+        # The batch is split until the failing message is isolated
+        self.messages._run_mqtt_router()
+        self.assertEqual(poison.state, "enqueued")
+        self.assertEqual(poison.delivery_ids.state, "failed")
+        self.assertEqual(poison.delivery_ids.attempts, 1)
+        self.assertEqual(self.messages[0].state, "processed")
+        self.assertEqual(set(self.messages[2:].mapped("state")), {"enqueued"})
+        self.assertFalse(self.messages[2:].delivery_ids)
+
+        self.messages._run_mqtt_router()
+        self.assertEqual(poison.delivery_ids.state, "dead")
+        self.assertEqual(poison.state, "dead")
+        self.assertIn("poison", poison.error)
+
+        # The messages after the poison are delivered without it
+        self.messages._run_mqtt_router()
+        self.assertEqual(set(self.messages[2:].mapped("state")), {"processed"})
+
+        poison.action_retry()
+        self.assertEqual(poison.state, "enqueued")
+        self.assertFalse(poison.delivery_ids)
+        self.assertFalse(poison.error)
+
+    def test_mqtt_router_backoff(self):
+        self.messages.env.cr.commit = MagicMock()
+        self.messages.env.cr.rollback = MagicMock()
+        proc = self._create_processor()
+        proc.write({"topic": "proc/#", "code": "raise UserError('abc')"})
+        self.messages.write(
+            {"state": "enqueued", "direction": "incoming", "topic": "proc/abc"}
+        )
+
+        self.env["ir.config_parameter"].sudo().set_param(
+            "mqtt.router_retry_delay", "3600"
+        )
+        # The bisection stops at the first failing message
+        rollback = self.messages.env.cr.rollback
+        self.messages._run_mqtt_router()
+        self.assertEqual(rollback.call_count, 3)
+        self.assertEqual(self.messages.delivery_ids.message_id, self.messages[0])
+
+        # Every run isolates the next failing message
+        for _i in range(3):
+            self.messages._run_mqtt_router()
+        self.assertEqual(rollback.call_count, 8)
+
+        # The next attempt is postponed and the router skips the messages
+        self.assertFalse(self.messages._run_mqtt_router())
+        self.assertEqual(rollback.call_count, 8)
+        self.assertTrue(all(self.messages.mapped("delivery_ids.next_attempt")))
+        self.assertTrue(all(self.messages.mapped("next_attempt")))
+
+    def test_indexes(self):
+        for name in (
+            "mqtt_message_outgoing_queue_index",
+            "mqtt_message_incoming_queue_index",
+            "mqtt_message_gc_index",
+        ):
+            self.assertTrue(tools.index_exists(self.env.cr, name))
+
+    def test_mqtt_router_partitions(self):
+        proc = self._create_processor()
+        self.messages.write({"direction": "incoming"})
+        groups = self.messages._group_by_subscriber()
+        subscriber = next(sub for sub in groups if sub.target == proc.id)
+
+        icp = self.env["ir.config_parameter"].sudo()
+        icp.set_param("mqtt.router_partition", "subscriber")
+        partitions = self.messages._get_router_partitions(groups)
+        self.assertEqual(len(partitions), len(groups))
+
+        icp.set_param("mqtt.router_partition", "topic")
+        partitions = self.messages._get_router_partitions(groups)
+        subbed = [msgs for sub, msgs in partitions if sub == subscriber]
+        self.assertEqual(len(subbed), 3)
+        for msgs in subbed:
+            self.assertEqual(len(set(msgs.mapped("topic"))), 1)
+
+    def test_mqtt_router_workers(self):
+        icp = self.env["ir.config_parameter"].sudo()
+        icp.set_param("mqtt.router_workers", "invalid")
+        self.assertEqual(self.messages._get_router_workers(), 1)
+        icp.set_param("mqtt.router_workers", "0")
+        self.assertEqual(self.messages._get_router_workers(), 1)
+        icp.set_param("mqtt.router_workers", "4")
+        self.assertEqual(self.messages._get_router_workers(), 4)
+
     def test_mqtt_router_processor(self):
         self.messages.env.cr.commit = MagicMock()
         self.messages.env.cr.rollback = MagicMock()
@@ -147,11 +342,19 @@ class TestMessage(TransactionCase):
         self.messages._run_mqtt_router()
 
         self.messages.env.cr.commit.assert_called_once()
+        self.assertEqual(set(self.messages.mapped("state")), {"processed"})
 
+        # Messages are delivered only once to each subscriber
         proc.code = "raise UserError('abc')"
         self.messages.write({"state": "enqueued", "direction": "incoming"})
         self.messages._run_mqtt_router()
+        self.messages.env.cr.rollback.assert_not_called()
+
+        self.messages.mapped("delivery_ids").unlink()
+        self.messages.write({"state": "enqueued", "direction": "incoming"})
+        self.messages._run_mqtt_router()
         self.messages.env.cr.rollback.assert_called_once()
+        self.assertEqual(set(self.messages.mapped("state")), {"enqueued"})
 
     def test_publish(self):
         msg = self.messages.mqtt_publish("testing/new", {"pay": "load"})
@@ -159,6 +362,93 @@ class TestMessage(TransactionCase):
         self.assertEqual(msg.topic, "testing/new")
         self.assertEqual(msg.payload, '{"pay": "load"}')
 
+    def test_publish_binary(self):
+        msg = self.messages.mqtt_publish("testing/new", b"\x00\xff")
+        self.assertEqual(msg.payload_encoding, "binary")
+        self.assertEqual(msg.get_payload(), b"\x00\xff")
+
+        msg = self.messages.mqtt_publish("testing/new", "text")
+        self.assertEqual(msg.payload_encoding, "text")
+        self.assertEqual(msg.get_payload(), "text")
+
+        msg = self.messages.create({"topic": "testing/new"})
+        msg.write({"payload_encoding": "binary", "payload": "AP8="})
+        self.assertEqual(msg.get_payload(), b"\x00\xff")
+        with self.assertRaises(ValidationError):
+            msg.payload = "not base64!"
+
+        # Each message keeps its encoding
+        msgs = msg | self.messages.create({"topic": "testing/new", "payload": "AP8="})
+        self.assertEqual(msgs.mapped("payload_encoding"), ["binary", "text"])
+        msgs.write({"payload": "AP8="})
+        self.assertEqual(msgs.mapped("payload_size"), [2, 4])
+        self.assertEqual(msgs[1].get_payload(), "AP8=")
+
+    def test_publish_compressed(self):
+        icp = self.env["ir.config_parameter"]
+        icp.set_param("mqtt.payload_compression", "zlib")
+        icp.set_param("mqtt.payload_threshold", "100")
+
+        payload = "compressed " * 100
+        msg = self.messages.mqtt_publish("testing/new", payload)
+        self.assertEqual(msg.payload_codec, "zlib")
+        self.assertEqual(msg.payload_size, len(payload))
+        self.assertLess(len(msg.payload_data), len(payload))
+        msg.invalidate_cache()
+        self.assertEqual(msg.payload, payload)
+        self.assertEqual(msg.get_payload(), payload)
+
+        # Small payloads aren't compressed
+        msg = self.messages.mqtt_publish("testing/new", "small")
+        self.assertEqual(msg.payload_codec, "none")
+        self.assertEqual(msg.payload_size, 5)
+
+        icp.set_param("mqtt.payload_compression", "lzma")
+        msg = self.messages.mqtt_publish("testing/new", b"\x00" * 1000)
+        self.assertEqual(msg.payload_codec, "lzma")
+        self.assertEqual(msg.payload_size, 1000)
+        msg.invalidate_cache()
+        self.assertEqual(msg.get_payload(), b"\x00" * 1000)
+
+        # Writing the payload stores it again
+        msg.write({"payload_encoding": "text"})
+        msg.payload = payload
+        self.assertEqual(msg.payload_codec, "lzma")
+        self.assertEqual(msg.payload_size, len(payload))
+        msg.invalidate_cache()
+        self.assertEqual(msg.payload, payload)
+
+    def test_pack_payload(self):
+        self.assertEqual(pack_payload(None), (None, "none", 0, "binary"))
+        self.assertEqual(pack_payload("äb"), ("äb".encode(), "none", 3, "text"))
+        self.assertEqual(
+            pack_payload(b"ab", encoding="text"), (b"ab", "none", 2, "text")
+        )
+
+        # Compression is only used if it reduces the size
+        data, codec, size, _enc = pack_payload(b"\x00" * 64, "zlib", 10)
+        self.assertEqual((codec, size), ("zlib", 64))
+        self.assertEqual(unpack_payload(data, codec), b"\x00" * 64)
+        self.assertEqual(pack_payload(b"\x01\x02", "zlib", 0)[1], "none")
+
+        self.assertEqual(get_compression({}.get), (DEFAULT_CODEC, DEFAULT_THRESHOLD))
+        params = {"mqtt.payload_compression": "foo", "mqtt.payload_threshold": "a"}
+        self.assertEqual(get_compression(params.get), ("none", DEFAULT_THRESHOLD))
+
+    @skipIf(msgpack is None, "msgpack is not installed")
+    def test_publish_msgpack(self):
+        data = {"pay": "load", "values": [1, 2.5, None]}
+        msg = self.messages.mqtt_publish("testing/new", data, payload_format="msgpack")
+        self.assertEqual(msg.payload_encoding, "binary")
+        self.assertEqual(msg.decode("msgpack"), data)
+
+    @skipIf(cbor2 is None, "cbor2 is not installed")
+    def test_publish_cbor(self):
+        data = {"pay": "load", "values": [1, 2.5, None]}
+        msg = self.messages.mqtt_publish("testing/new", data, payload_format="cbor")
+        self.assertEqual(msg.payload_encoding, "binary")
+        self.assertEqual(msg.decode("cbor"), data)
+
     def test_onchange_topic(self):
         msg = self.messages[0]
         msg._onchange_topic()
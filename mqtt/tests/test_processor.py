@@ -4,6 +4,8 @@
 from odoo.exceptions import UserError
 from odoo.tests import TransactionCase
 
+from ..snippet import SnippetCache, snippets
+
 
 class TestProcessor(TransactionCase):
     def setUp(self):
@@ -29,6 +31,14 @@ class TestProcessor(TransactionCase):
         with self.assertRaises(UserError):
             self.proc.process(message)
 
+    def test_decode(self):
+        self.proc.code = "messages.write({'topic': decode(messages)['topic']})"
+        message = self.messages.create(
+            {"topic": "testing/b/b/c", "payload": '{"topic": "testing/decoded"}'}
+        )
+        self.proc.process(message)
+        self.assertEqual(message.topic, "testing/decoded")
+
     def test_context(self):
         ctx = self.proc._get_eval_context()
         self.assertEqual(ctx["env"].user, self.env.user)
@@ -40,3 +50,28 @@ class TestProcessor(TransactionCase):
         self.assertNotEqual(ctx["env"].user, self.env.user)
         self.assertNotEqual(ctx["model"].env.user, self.env.user)
         self.assertNotEqual(self.proc.user_id, self.env.user)
+
+    def test_code(self):
+        self.proc.code = "messages.write({'payload': 'done'})"
+        message = self.messages.create({"topic": "testing/b/b/c"})
+        self.proc.process(message)
+        self.assertEqual(message.payload, "done")
+
+        # Forbidden opcodes are rejected
+        self.proc.code = "import os"
+        with self.assertRaises(ValueError):
+            self.proc.process(message)
+
+    def test_snippet_cache(self):
+        compiled = snippets.compile(self.proc, "code")
+        self.assertIs(compiled, snippets.compile(self.proc, "code"))
+
+        # Changed code is compiled again
+        self.proc.code = "messages.write({'payload': 'done'})"
+        self.assertIsNot(compiled, snippets.compile(self.proc, "code"))
+
+        self.proc.code = "1"
+        cache = SnippetCache(size=1)
+        cache.compile(self.proc, "code", mode="eval")
+        cache.compile(self.proc, "code", mode="exec")
+        self.assertEqual(len(cache), 1)
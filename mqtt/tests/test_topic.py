@@ -0,0 +1,123 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from unittest.mock import patch
+
+from odoo.tests import TransactionCase
+
+from ..topic import TopicTrie, compile_topic, is_valid_subscription, render_topic
+
+
+class TestTopic(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        self.trie = TopicTrie()
+        for subscription in (
+            "#",
+            "testing/#",
+            "testing/+",
+            "testing/+/b/c",
+            "testing/a/b/c",
+            "+/+",
+        ):
+            self.assertTrue(self.trie.add(subscription, subscription))
+
+    def test_valid(self):
+        self.assertTrue(is_valid_subscription("#"))
+        self.assertTrue(is_valid_subscription("a/+/c/#"))
+        self.assertFalse(is_valid_subscription(""))
+        self.assertFalse(is_valid_subscription("a/#/c"))
+        self.assertFalse(is_valid_subscription("a/b+"))
+        self.assertFalse(self.trie.add("testing/#a", "invalid"))
+        self.assertEqual(len(self.trie), 6)
+
+    def test_match(self):
+        self.assertEqual(
+            self.trie.match("testing/a/b/c"),
+            ["#", "testing/#", "testing/+/b/c", "testing/a/b/c"],
+        )
+        self.assertEqual(
+            self.trie.match("testing/a"), ["#", "testing/#", "testing/+", "+/+"]
+        )
+        self.assertEqual(self.trie.match("testing"), ["#", "testing/#"])
+        self.assertEqual(self.trie.match("other/a/b"), ["#"])
+
+    def test_system_topics(self):
+        self.assertEqual(self.trie.match("$SYS/a"), [])
+        self.trie.add("$SYS/#", "system")
+        self.assertEqual(self.trie.match("$SYS/a"), ["system"])
+
+    def test_compile(self):
+        self.assertEqual(
+            compile_topic("odoo/{code}/{client}", code="create", client="abc"),
+            ("odoo/create/abc", ()),
+        )
+        self.assertEqual(compile_topic("odoo/{"), ("odoo/{", ()))
+
+        topic, names = compile_topic("odoo/{code}/{id}/{company_id}/{id}", code="a")
+        self.assertEqual(names, ("id", "company_id"))
+        self.assertEqual(
+            render_topic(topic, {"id": 42, "company_id": "1#+"}), "odoo/a/42/1/42"
+        )
+
+    def test_intern(self):
+        messages = self.env["mqtt.message"].create(
+            [
+                {"topic": "testing/intern/a"},
+                {"topic": "testing/intern/a", "direction": "incoming"},
+                {"topic": "testing/intern/b"},
+                {"topic": False},
+            ]
+        )
+        a, b, empty = messages[0], messages[2], messages[3]
+
+        # Messages with the same topic share the entry
+        self.assertEqual(a.topic_id, messages[1].topic_id)
+        self.assertNotEqual(a.topic_id, b.topic_id)
+        self.assertFalse(empty.topic_id)
+        self.assertFalse(empty.topic)
+
+        topic, old = a.topic_id, b.topic_id
+        self.assertEqual(topic.topic, "testing/intern/a")
+        self.assertEqual(topic.root, "testing")
+        self.assertEqual(topic.depth, 3)
+        self.assertTrue(topic.first_seen)
+
+        # The statistics are updated afterwards
+        self.assertFalse(topic.incoming_count or topic.outgoing_count)
+        self.assertFalse(topic.last_seen)
+        # Recent messages might not be committed and are counted later
+        self.env["mqtt.topic"]._update_statistics()
+        self.assertFalse(topic.incoming_count or topic.outgoing_count)
+        self.env["mqtt.topic"]._update_statistics(delay=0)
+        self.assertEqual(topic.incoming_count, 1)
+        self.assertEqual(topic.outgoing_count, 1)
+        self.assertTrue(topic.last_seen)
+
+        # Changing the topic of a message interns the new topic without
+        # counting the message again
+        b.topic = "testing/intern/a"
+        self.assertEqual(b.topic_id, topic)
+        self.env["mqtt.topic"]._update_statistics(delay=0)
+        self.assertEqual(topic.outgoing_count, 1)
+
+        # Topics without messages are removed
+        self.env["mqtt.topic"]._gc_topics()
+        self.assertFalse(old.exists())
+        self.assertTrue(topic.exists())
+
+        found = self.env["mqtt.message"].search([("topic", "=", "testing/intern/a")])
+        self.assertEqual(found, messages[:3])
+        self.assertIn(empty, self.env["mqtt.message"].search([("topic", "=", False)]))
+
+    def test_match_once(self):
+        messages = self.env["mqtt.message"].create(
+            [{"topic": "testing/match", "direction": "incoming"} for _i in range(5)]
+        )
+        self.assertEqual(len(messages.mapped("topic_id")), 1)
+
+        # The subscription is matched only once for the shared topic
+        with patch.object(TopicTrie, "match", autospec=True) as mock:
+            mock.return_value = ["match"]
+            self.assertEqual(messages._filter_by_subscription("testing/#"), messages)
+            mock.assert_called_once()
@@ -0,0 +1,130 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import string
+
+
+def is_valid_subscription(subscription):
+    """Check if the subscription is a valid MQTT topic filter"""
+    if not subscription:
+        return False
+
+    levels = subscription.split("/")
+    for i, level in enumerate(levels):
+        if level == "#" and i < len(levels) - 1:
+            return False
+        if level not in ("#", "+") and any(k in level for k in "#+"):
+            return False
+    return True
+
+
+def _escape(text):
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def compile_topic(template, **values):
+    """Replace the given placeholders of the topic template. Returns the topic
+    and the names of the remaining placeholders. If placeholders remain the
+    topic is a format string to be filled with `render_topic`"""
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError:
+        # Keep malformed templates as they are
+        return template, ()
+
+    parts, names = [], []
+    for literal, name, _spec, _conversion in parsed:
+        parts.append(literal)
+        if name is None:
+            continue
+        if name in values:
+            parts.append(str(values[name]))
+        else:
+            parts.append(None)
+            names.append(name)
+
+    if not names:
+        return "".join(parts), ()
+
+    # Build a format string with only the remaining placeholders
+    remaining = iter(names)
+    topic = "".join(
+        f"{{{next(remaining)}}}" if part is None else _escape(part) for part in parts
+    )
+    return topic, tuple(dict.fromkeys(names))
+
+
+def render_topic(topic, values):
+    """Fill the placeholders of a compiled topic. Wildcards are removed from the
+    values because they aren't allowed in topics used for publishing"""
+    return topic.format_map(
+        {
+            name: str(value).replace("#", "").replace("+", "")
+            for name, value in values.items()
+        }
+    )
+
+
+class _Node:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicTrie:
+    """Trie over the levels of MQTT topic filters. Matching a topic against all
+    filters only visits the levels of the topic and the wildcard branches"""
+
+    def __init__(self):
+        self.root = _Node()
+        self.order = {}
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, subscription, value):
+        """Add the value under the topic filter. Returns False if the filter
+        isn't valid"""
+        if not is_valid_subscription(subscription):
+            return False
+
+        node = self.root
+        for level in subscription.split("/"):
+            node = node.children.setdefault(level, _Node())
+
+        node.values.append(value)
+        self.order.setdefault(value, len(self.order))
+        return True
+
+    def match(self, topic):
+        """Returns the values of all filters matching the topic in the order
+        they were added. Wildcards on the first level don't match topics starting
+        with $ as defined by the MQTT specification"""
+        levels = topic.split("/")
+        system = levels[0].startswith("$")
+
+        result = []
+        stack = [(self.root, 0)]
+        while stack:
+            node, i = stack.pop()
+
+            # The multi-level wildcard includes the parent level
+            wildcard = node.children.get("#")
+            if wildcard and not (i == 0 and system):
+                result.extend(wildcard.values)
+
+            if i == len(levels):
+                result.extend(node.values)
+                continue
+
+            child = node.children.get(levels[i])
+            if child:
+                stack.append((child, i + 1))
+
+            wildcard = node.children.get("+")
+            if wildcard and not (i == 0 and system):
+                stack.append((wildcard, i + 1))
+
+        return sorted(set(result), key=self.order.get)
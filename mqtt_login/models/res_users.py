@@ -24,12 +24,12 @@ class ResUsers(models.Model):
             "login_date": self.login_date,
         }
 
-        etype = self.env.ref("mqtt_login.type_login")
-        domain = [("model", "=", self._name), ("type_ids", "=", etype.id)]
-        for event in self.env["mqtt.event"].search(domain):
+        for descriptor in self._mqtt_events("mqtt_login.type_login"):
+            topic = next(iter(self._mqtt_group_by_topic(descriptor)))
             self.mqtt_publish(
-                event.convert_topic(etype),
+                topic,
                 payload=payload,
-                qos=event.qos,
-                retain=event.retain,
+                qos=descriptor.qos,
+                retain=descriptor.retain,
+                payload_format=descriptor.payload_format,
             )
@@ -1,8 +1,12 @@
 # © 2022 Florian Kantelberg - initOS GmbH
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+from unittest import skipIf
+
 from odoo.tests import TransactionCase
 
+from odoo.addons.mqtt.formats import msgpack
+
 
 class TestClient(TransactionCase):
     def setUp(self):
@@ -22,3 +26,11 @@ class TestClient(TransactionCase):
         self.env.user._mqtt_login_events()
         after = self.env["mqtt.message"].search_count([])
         self.assertTrue(before < after)
+
+    @skipIf(msgpack is None, "msgpack is not installed")
+    def test_mqtt_login_msgpack(self):
+        self.event.payload_format = "msgpack"
+        self.env.user._mqtt_login_events()
+        msg = self.env["mqtt.message"].search([("topic", "=", "odoo/login")], limit=1)
+        self.assertEqual(msg.payload_encoding, "binary")
+        self.assertEqual(msg.decode("msgpack")["login"], self.env.user.login)
@@ -12,6 +12,7 @@
     "data": [
         "views/mqtt_processor_views.xml",
         "views/mqtt_event_views.xml",
+        "views/serializer_views.xml",
     ],
     "demo": [
         "demo/demo_users.xml",
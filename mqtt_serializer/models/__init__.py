@@ -1,4 +1,4 @@
 # © 2022 Florian Kantelberg - initOS GmbH
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from . import mqtt_event, mqtt_processor
+from . import mqtt_event, mqtt_processor, serializer
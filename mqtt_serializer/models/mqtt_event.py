@@ -19,6 +19,22 @@ class MQTTEvent(models.Model):
         self.ensure_one()
 
         if self.mapping == "serializer":
-            return self.serializer_id.serialize(records)
+            chunks = self.serializer_id.serialize_stream(
+                records, payload_format=self.payload_format
+            )
+            return (
+                "".join(chunks) if self.payload_format == "json" else b"".join(chunks)
+            )
 
         return super()._to_payload(records, fields)
+
+    def _to_payloads(self, records, fields=None):
+        self.ensure_one()
+
+        if self.mapping == "serializer":
+            result = {}
+            for batch, data in self.serializer_id._serialize_batches(records):
+                result.update(zip(batch.ids, data))
+            return result
+
+        return super()._to_payloads(records, fields)
@@ -1,7 +1,7 @@
 # © 2022 Florian Kantelberg - initOS GmbH
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import fields, models
+from odoo import api, fields, models
 
 
 class MQTTProcessor(models.Model):
@@ -12,8 +12,24 @@ class MQTTProcessor(models.Model):
         domain="[('model_id', '=', model_id)]",
     )
 
+    @api.model
+    def default_variables(self):
+        res = super().default_variables()
+        res.update(
+            {
+                "serializer": "The serializer of the processor",
+                "deserialize": "Function to deserialize the payload of a message "
+                "with the serializer in its format",
+            }
+        )
+        return res
+
     def _get_eval_context(self):
         ctx = super()._get_eval_context()
         if self.serializer_id:
-            ctx["serializer"] = self.serializer_id
+            serializer = self.serializer_id
+            ctx["serializer"] = serializer
+            ctx["deserialize"] = lambda message: serializer.deserialize(
+                message.get_payload()
+            )
         return ctx
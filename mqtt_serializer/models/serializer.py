@@ -0,0 +1,55 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import _, fields, models
+from odoo.exceptions import UserError
+
+from odoo.addons.mqtt.formats import (
+    PAYLOAD_FORMATS,
+    array_end,
+    array_start,
+    decode_payload,
+    encode_payload,
+)
+
+
+class Serializer(models.Model):
+    _inherit = "ir.serializer"
+
+    payload_format = fields.Selection(
+        PAYLOAD_FORMATS,
+        "Format",
+        default="json",
+        required=True,
+        help="Format of the serialized data. The binary formats require additional "
+        "python libraries",
+    )
+
+    def _loads(self, content):
+        if self.payload_format == "json":
+            return super()._loads(content)
+        return decode_payload(content, self.payload_format)
+
+    def _dumps(self, data):
+        if self.payload_format == "json":
+            return super()._dumps(data)
+        return encode_payload(data, self.payload_format)
+
+    def serialize_stream(
+        self, records, ndjson=False, batch_size=None, payload_format=None
+    ):
+        """Serialize the records and yield the output in chunks. The chunks are
+        strings for JSON and bytes for the binary formats"""
+        self.ensure_one()
+        payload_format = payload_format or self.payload_format
+        if payload_format == "json":
+            yield from super().serialize_stream(records, ndjson, batch_size)
+            return
+
+        if ndjson:
+            raise UserError(_("Newline delimited output is only supported for JSON"))
+
+        yield array_start(payload_format, len(records))
+        for _batch, data in self._serialize_batches(records, batch_size):
+            yield b"".join(encode_payload(item, payload_format) for item in data)
+        yield array_end(payload_format)
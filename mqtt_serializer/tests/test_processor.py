@@ -0,0 +1,64 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from unittest import skipIf
+
+from odoo.fields import Command
+from odoo.tests import TransactionCase
+
+from odoo.addons.mqtt.formats import cbor2, encode_payload, msgpack
+
+
+class TestProcessor(TransactionCase):
+    def setUp(self):
+        super().setUp()
+
+        model = self.env.ref("base.model_res_partner")
+        self.serializer = self.env["ir.serializer"].create(
+            {
+                "name": "Test Serializer",
+                "model_id": model.id,
+                "use_sync_date": False,
+                "field_ids": [
+                    Command.create(
+                        {"field_id": self.env.ref(f"base.field_res_partner__{f}").id}
+                    )
+                    for f in ("name", "ref")
+                ],
+            }
+        )
+        self.proc = self.env["mqtt.processor"].create(
+            {
+                "name": "Testing processor",
+                "model_id": model.id,
+                "topic": "testing/#",
+                "serializer_id": self.serializer.id,
+                "code": "for message in messages:\n"
+                "    model.create(deserialize(message))",
+            }
+        )
+
+    def _test_deserialize(self, payload_format):
+        self.serializer.payload_format = payload_format
+        rows = [{"name": "Deserialized", "ref": f"deserialized-{payload_format}"}]
+        message = self.env["mqtt.message"].mqtt_publish(
+            "testing/serializer", encode_payload(rows, payload_format)
+        )
+
+        self.proc.process(message)
+        partner = self.env["res.partner"].search([("ref", "=", rows[0]["ref"])])
+        self.assertEqual(partner.name, "Deserialized")
+
+    def test_deserialize_json(self):
+        self._test_deserialize("json")
+
+    @skipIf(msgpack is None, "msgpack is not installed")
+    def test_deserialize_msgpack(self):
+        self._test_deserialize("msgpack")
+
+    @skipIf(cbor2 is None, "cbor2 is not installed")
+    def test_deserialize_cbor(self):
+        self._test_deserialize("cbor")
+
+    def test_help(self):
+        self.assertIn("<code>deserialize</code>", self.proc.help_text)
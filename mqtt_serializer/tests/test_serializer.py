@@ -0,0 +1,75 @@
+# © 2022 Florian Kantelberg - initOS GmbH
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from unittest import skipIf
+
+from odoo.exceptions import UserError
+from odoo.fields import Command
+from odoo.tests import TransactionCase
+
+from odoo.addons.mqtt.formats import cbor2, msgpack
+
+
+class TestSerializer(TransactionCase):
+    def setUp(self):
+        super().setUp()
+
+        self.serializer = self.env["ir.serializer"].create(
+            {
+                "name": "Test Serializer",
+                "model_id": self.env.ref("base.model_res_partner").id,
+                "use_sync_date": False,
+                "field_ids": [
+                    self._create_field("name"),
+                    self._create_field("ref"),
+                ],
+            }
+        )
+
+        self.parent = self.env["res.partner"].create(
+            {"name": "Test Parent", "ref": "parent", "is_company": True}
+        )
+        self.partner = self.env["res.partner"].create(
+            {"name": "Test Partner", "ref": "partner", "parent_id": self.parent.id}
+        )
+        self.records = self.parent | self.partner | self.partner.child_ids
+
+    def _create_field(self, name):
+        return Command.create(
+            {"field_id": self.env.ref(f"base.field_res_partner__{name}").id}
+        )
+
+    def test_format_json(self):
+        content = self.serializer.serialize(self.records)
+        self.assertIsInstance(content, str)
+        self.assertEqual(
+            "".join(self.serializer.serialize_stream(self.records)), content
+        )
+
+    def _test_binary_format(self, payload_format):
+        self.serializer.payload_format = payload_format
+        records = self.records
+
+        content = self.serializer.serialize(records)
+        self.assertIsInstance(content, bytes)
+        self.assertEqual(
+            b"".join(self.serializer.serialize_stream(records, batch_size=1)), content
+        )
+        self.assertEqual(
+            self.serializer.deserialize(content),
+            [{"name": r.name, "ref": r.ref} for r in records],
+        )
+
+        with self.assertRaises(UserError):
+            self.serializer.deserialize(content.decode("latin-1"))
+
+        with self.assertRaises(UserError):
+            list(self.serializer.serialize_stream(records, ndjson=True))
+
+    @skipIf(msgpack is None, "msgpack is not installed")
+    def test_format_msgpack(self):
+        self._test_binary_format("msgpack")
+
+    @skipIf(cbor2 is None, "cbor2 is not installed")
+    def test_format_cbor(self):
+        self._test_binary_format("cbor")
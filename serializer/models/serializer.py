@@ -3,14 +3,88 @@
 
 import json
 import logging
+from collections import OrderedDict, defaultdict, namedtuple
 from datetime import datetime
 
-from odoo import _, api, fields, models
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import UserError, ValidationError
-from odoo.tools import safe_eval
+from odoo.tools import safe_eval, split_every
+
+from ..snippet import snippets
 
 _logger = logging.getLogger(__name__)
 
+# Field types which are exported and imported without conversion
+SIMPLE_TYPES = (
+    "boolean",
+    "char",
+    "float",
+    "html",
+    "integer",
+    "monetary",
+    "selection",
+    "text",
+)
+
+# Number of rows which are matched and imported at once
+IMPORT_CHUNK = 1000
+
+# Exported field of a serializer. `kind` defines the conversion of the value
+ExportField = namedtuple("ExportField", ["key", "fname", "kind", "serializer"])
+
+
+def _copy_output(value):
+    """Copy the dictionaries and lists of a serialized output"""
+    if isinstance(value, dict):
+        return {k: _copy_output(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return list(map(_copy_output, value))
+    return value
+
+
+class ExportMemo:
+    """Least recently used outputs of related records within one serialization.
+    The output of a record is only reused if none of the records and serializers
+    it was generated from are part of the current path because the loop
+    detection would change the output"""
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        # Visited records and detected loops of the records being serialized
+        self.frames = []
+
+    def get(self, key, path):
+        entry = self.data.get(key)
+        if entry is None or not entry[1].isdisjoint(path):
+            return None
+
+        self.data.move_to_end(key)
+        if self.frames:
+            self.frames[-1][0].update(entry[1])
+        return _copy_output(entry[0])
+
+    def put(self, key, result, footprint):
+        self.data[key] = (result, frozenset(footprint))
+        self.data.move_to_end(key)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def enter(self):
+        self.frames.append((set(), [False]))
+
+    def leave(self, key):
+        footprint, loop = self.frames.pop()
+        footprint.add(key)
+        if self.frames:
+            self.frames[-1][0].update(footprint)
+            self.frames[-1][1][0] |= loop[0]
+        return footprint, loop[0]
+
+    def mark_loop(self):
+        if self.frames:
+            self.frames[-1][1][0] = True
+
 
 class SerializerField(models.Model):
     _name = "ir.serializer.field"
@@ -46,6 +120,27 @@ class SerializerField(models.Model):
         )
     ]
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        # Rebuild the import plans of the serializers
+        self.clear_caches()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        # Only these fields are part of the import plans
+        if {"serializer_id", "field_id", "name", "importing"}.intersection(vals):
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        importing = any(self.mapped("importing"))
+        res = super().unlink()
+        if importing:
+            self.clear_caches()
+        return res
+
     @api.depends("field_id")
     def _compute_related(self):
         for rec in self:
@@ -55,16 +150,7 @@ class SerializerField(models.Model):
         self.ensure_one()
 
         fname = self.field_id.name
-        if self.ttype in (
-            "boolean",
-            "char",
-            "float",
-            "html",
-            "integer",
-            "monetary",
-            "selection",
-            "text",
-        ):
+        if self.ttype in SIMPLE_TYPES:
             return record[fname]
 
         if self.ttype in ("date", "datetime"):
@@ -92,16 +178,7 @@ class SerializerField(models.Model):
 
     def _deserialize(self, value):
         self.ensure_one()
-        if self.ttype in (
-            "boolean",
-            "char",
-            "float",
-            "html",
-            "integer",
-            "monetary",
-            "selection",
-            "text",
-        ):
+        if self.ttype in SIMPLE_TYPES:
             return value
 
         if self.ttype == "date":
@@ -120,6 +197,18 @@ class SerializerField(models.Model):
 
         raise NotImplementedError(f"Field type {self.ttype} is not supported")
 
+    def _get_export_kind(self):
+        self.ensure_one()
+        if self.ttype in SIMPLE_TYPES:
+            return "value"
+        if self.ttype in ("date", "datetime"):
+            return "date"
+        if self.related and self.ttype == "many2one":
+            return "many2one"
+        if self.related and self.ttype in ("many2many", "one2many"):
+            return "x2many"
+        return None
+
 
 class Serializer(models.Model):
     _name = "ir.serializer"
@@ -147,6 +236,11 @@ class Serializer(models.Model):
     )
     raise_on_duplicate = fields.Boolean(default=True)
     include_empty_keys = fields.Boolean(default=False)
+    cache_size = fields.Integer(
+        default=1000,
+        help="Maximum number of related records whose output is reused within one "
+        "serialization. Use 0 to disable it",
+    )
 
     @api.constrains("field_ids")
     def _check_fields(self):
@@ -186,6 +280,17 @@ class Serializer(models.Model):
             if not isinstance(domain, (list, tuple)):
                 raise ValidationError(_("Invalid domain"))
 
+    def write(self, vals):
+        res = super().write(vals)
+        if "field_ids" in vals:
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
     @api.depends("exporting", "importing")
     def _compute_active(self):
         for rec in self:
@@ -228,7 +333,7 @@ class Serializer(models.Model):
 
     def _get_import_domain(self, values):
         self.ensure_one()
-        return safe_eval.safe_eval(self.import_domain, values)
+        return snippets.run(self, "import_domain", dict(values), mode="eval")
 
     def action_populate(self):
         self._populate()
@@ -252,8 +357,17 @@ class Serializer(models.Model):
             (0, 0, {"field_id": field.id}) for field in fields.search(domain)
         ]
 
+    def _loads(self, content):
+        """Decode the serialized content into python objects"""
+        return json.loads(content)
+
+    def _dumps(self, data):
+        """Encode the python objects of the serialization"""
+        return json.dumps(data)
+
     def deserialize(self, content):
-        content = json.loads(content)
+        self.ensure_one()
+        content = self._loads(content)
         if not isinstance(content, (list, tuple)):
             raise UserError(_("Expected a dictionary of list of dictionaries"))
 
@@ -262,36 +376,42 @@ class Serializer(models.Model):
 
         return list(map(self._deserialize, content))
 
+    @tools.ormcache("self.id")
+    def _get_import_plan(self):
+        """Returns the IDs of the importing fields by the key used in the
+        serialized data and by the name of the model field. The result is
+        cached until a serializer or its fields change"""
+        by_key, by_fname = {}, {}
+        for field in self.field_ids.filtered("importing"):
+            by_key[field.name or field.field_id.name] = field.id
+            by_fname[field.field_id.name] = field.id
+        return by_key, by_fname
+
+    def _get_import_field(self, field_id):
+        field_ids = self.field_ids
+        return field_ids.browse(field_id).with_prefetch(field_ids._prefetch_ids)
+
     def _deserialize(self, content):
         self.ensure_one()
 
         if not isinstance(content, dict):
             raise UserError(_("Expected a dictionary"))
 
+        by_key, _by_fname = self._get_import_plan()
         result = {}
         for key, value in content.items():
-            domain = [
-                ("name", "=", key),
-                ("importing", "=", True),
-            ]
-            field = self.field_ids.filtered_domain(domain)
-            if not field:
-                domain = [
-                    ("name", "=", False),
-                    ("field_id.name", "=", key),
-                    ("importing", "=", True),
-                ]
-                field = self.field_ids.filtered_domain(domain)
-
-            if not field:
+            field_id = by_key.get(key)
+            if not field_id:
                 continue
 
+            field = self._get_import_field(field_id)
+
             result[field.field_id.name] = field._deserialize(value)
 
         if self.use_snippet and self.import_code:
             ctx = self._get_eval_context()
             ctx.update({"content": content, "result": result})
-            safe_eval.safe_eval(self.import_code, ctx, mode="exec", nocopy=True)
+            snippets.run(self, "import_code", ctx)
 
         if self.use_sync_date and "sync_date" in content:
             result["sync_date"] = datetime.fromisoformat(content["sync_date"])
@@ -303,36 +423,183 @@ class Serializer(models.Model):
         if not isinstance(content, (list, tuple)):
             content = [content]
 
-        records = self.env[self.model_id.model]
-        for values in content:
-            domain = self._get_import_domain(values)
-            rec = self.env[self.model_id.model].search(domain)
-            if rec:
+        ids = []
+        for rows in split_every(IMPORT_CHUNK, content, list):
+            for records in self._import_rows(rows, create):
+                ids.extend(records.ids)
+
+        return self.env[self.model_id.model].browse(list(dict.fromkeys(ids)))
+
+    def _import_row(self, values, domain, create=True):
+        """Import a single row by searching the matching records"""
+        self.ensure_one()
+        rec = self.env[self.model_id.model].search(domain)
+        if rec:
+            writable = self._import_deserialized(values)
+            rec.write(writable)
+        elif create:
+            writable = self._import_deserialized(values)
+            rec = rec.create(writable)
+        return rec
+
+    def _get_import_key(self, domain):
+        """Returns the field names and values of a domain which only consists of
+        equality conditions on simple fields. Returns None if the domain can't be
+        matched in batches"""
+        if not isinstance(domain, (list, tuple)) or not domain:
+            return None
+
+        model = self.env[self.model_id.model]
+        key = {}
+        for leaf in domain:
+            if not isinstance(leaf, (list, tuple)) or len(leaf) != 3:
+                return None
+
+            fname, operator, value = leaf
+            field = model._fields.get(fname)
+            # Falsy values are searched as empty values by `in` conditions and
+            # wouldn't match in batches
+            if operator != "=" or fname in key or not field or not value:
+                return None
+
+            if field.type in ("integer", "many2one") or fname == "id":
+                valid = type(value) is int
+            elif field.type in ("char", "selection"):
+                valid = isinstance(value, str)
+            else:
+                valid = False
+
+            if not valid or not field.store or getattr(field, "translate", False):
+                return None
+
+            key[fname] = value
+
+        return tuple(sorted(key.items()))
+
+    def _match_import_keys(self, keys):
+        """Search the records of all keys with one query per set of fields.
+        Returns the matching records by key"""
+        model = self.env[self.model_id.model]
+        shapes = defaultdict(set)
+        for key in filter(None, keys):
+            shapes[tuple(fname for fname, _value in key)].add(key)
+
+        matches = defaultdict(list)
+        for fnames, shape_keys in shapes.items():
+            domain = []
+            for pos, fname in enumerate(fnames):
+                values = {key[pos][1] for key in shape_keys}
+                domain.append((fname, "in", list(values)))
+
+            for rec in model.search(domain):
+                key = []
+                for fname in fnames:
+                    value = rec[fname]
+                    if isinstance(value, models.BaseModel):
+                        value = value.id
+                    key.append((fname, value))
+
+                key = tuple(key)
+                if key in shape_keys:
+                    matches[key].append(rec.id)
+
+        return {key: model.browse(ids) for key, ids in matches.items()}
+
+    def _import_rows(self, rows, create=True):
+        """Import the rows and return the records of each row. Rows with simple
+        key domains are matched at once, written in groups and created with a
+        single create. Other rows are imported one by one"""
+        self.ensure_one()
+        model = self.env[self.model_id.model]
+        domains = [self._get_import_domain(values) for values in rows]
+        keys = [self._get_import_key(domain) for domain in domains]
+        results = [model] * len(rows)
+
+        # Pending writes grouped by the values and pending creates
+        to_write, to_create = {}, []
+        pending_ids, pending_keys = set(), set()
+
+        def flush():
+            for vals, ids in to_write.values():
+                model.browse(ids).write(vals)
+            if to_create:
+                created = model.create([vals for _idx, vals in to_create])
+                for (idx, _vals), rec in zip(to_create, created):
+                    results[idx] = rec
+
+            to_write.clear()
+            to_create.clear()
+            pending_ids.clear()
+            pending_keys.clear()
+
+        matches = None
+        for idx, (values, domain, key) in enumerate(zip(rows, domains, keys)):
+            # Fall back to the single import if the records of the row could
+            # be affected by the pending changes
+            if key is None or key in pending_keys:
+                flush()
+                results[idx] = self._import_row(values, domain, create)
+                matches = None
+                continue
+
+            if matches is None:
+                flush()
+                matches = self._match_import_keys(keys[idx:])
+
+            recs = matches.get(key, model)
+            if recs:
+                if pending_ids.intersection(recs.ids):
+                    flush()
+
                 writable = self._import_deserialized(values)
-                rec.write(writable)
+                group = self._get_write_group(writable)
+                if group is None:
+                    recs.write(writable)
+                else:
+                    to_write.setdefault(group, (writable, []))[1].extend(recs.ids)
+                    pending_ids.update(recs.ids)
+
+                # The written fields might change the matching of the next rows
+                if any(fname in writable for fname, _value in key):
+                    matches = None
+
+                results[idx] = recs
             elif create:
-                writable = self._import_deserialized(values)
-                rec = rec.create(writable)
-            records |= rec
+                to_create.append((idx, self._import_deserialized(values)))
+                pending_keys.add(key)
 
-        return records
+        flush()
+        return results
+
+    @api.model
+    def _get_write_group(self, vals):
+        """Returns a hashable representation of the values to group the writes
+        or None if the values can't be grouped"""
+        try:
+            group = tuple(sorted(vals.items()))
+            hash(group)
+        except TypeError:
+            return None
+        return group
 
     def _import_deserialized(self, content):
         self.ensure_one()
         if not isinstance(content, dict):
             raise UserError(_("Expected a dictionary"))
 
+        _by_key, by_fname = self._get_import_plan()
         writable = {}
         for key, value in content.items():
             if not isinstance(value, (dict, list, tuple)):
                 writable[key] = value
                 continue
 
-            domain = [("field_id.name", "=", key), ("importing", "=", True)]
-            field = self.field_ids.filtered_domain(domain)
-            if not field:
+            field_id = by_fname.get(key)
+            if not field_id:
                 continue
 
+            field = self._get_import_field(field_id)
+
             if field.ttype == "many2one":
                 writable[key] = field.related_serializer_id.import_deserialized(
                     value
@@ -345,7 +612,6 @@ class Serializer(models.Model):
                         changes.append((4, rec.id))
                     else:
                         rec_vals = field.related_serializer_id._import_deserialized(val)
-                        print(rec, rec_vals)
                         changes.append((0, 0, rec_vals))
 
                 writable[key] = changes
@@ -356,13 +622,192 @@ class Serializer(models.Model):
 
         return writable
 
-    def serialize(self, records):
+    def _get_export_plan(self):
+        """Returns the exported fields of the serializer"""
+        self.ensure_one()
+        return tuple(
+            ExportField(
+                field.name or field.field_id.name,
+                field.field_id.name,
+                field._get_export_kind(),
+                field.related_serializer_id,
+            )
+            for field in self.field_ids.filtered("exporting")
+        )
+
+    def _prefetch_export(self, records):
+        """Load the exported fields level by level. The fields are read for all
+        records of a serializer at once. Returns the plans of the serializers"""
+        self.ensure_one()
+        plans = {}
+        pending = defaultdict(set)
+        pending[self].update(records.ids)
+        loaded = defaultdict(set)
+        while pending:
+            serializer, ids = pending.popitem()
+            if serializer not in plans:
+                plans[serializer] = serializer._get_export_plan()
+
+            ids -= loaded[serializer]
+            if not ids:
+                continue
+
+            loaded[serializer].update(ids)
+            recs = records.env[serializer.model_id.model].browse(ids)
+            for entry in plans[serializer]:
+                if entry.kind in ("value", "date"):
+                    recs.mapped(entry.fname)
+                elif entry.kind in ("many2one", "x2many") and entry.serializer:
+                    pending[entry.serializer].update(recs.mapped(entry.fname).ids)
+
+        return plans
+
+    def _serialize_records(self, records):
+        """Serialize the records into a list of python objects. The values are
+        loaded in batches before the result is assembled"""
         self.ensure_one()
         self_ctx = self.with_context(
             include_empty_keys=self.include_empty_keys,
             raise_on_duplicate=self.raise_on_duplicate,
         )
-        return json.dumps(list(map(self_ctx._serialize, records)))
+        plans = self_ctx._prefetch_export(records)
+        memo = ExportMemo(self.cache_size) if self.cache_size > 0 else None
+        return [self_ctx._serialize_planned(rec, plans, set(), memo) for rec in records]
+
+    def _serialize_planned(self, record, plans, path, memo=None):
+        """Serialize the record using the plans. `path` contains the records and
+        serializers of the parent levels to detect loops. The output of related
+        records is reused from the memo if possible"""
+        self.ensure_one()
+
+        if not record:
+            return {} if self.env.context.get("include_empty_keys") else None
+
+        record.ensure_one()
+        key = (record, self)
+        if key in path:
+            if memo:
+                memo.mark_loop()
+            if self.env.context.get("raise_on_duplicate"):
+                raise UserError(_("Loop detected"))
+            return {} if self.env.context.get("include_empty_keys") else None
+
+        if memo and path:
+            cached = memo.get(key, path)
+            if cached is not None:
+                return cached
+
+        if self not in plans:
+            plans[self] = self._get_export_plan()
+
+        if memo:
+            memo.enter()
+
+        path.add(key)
+        result = {}
+        for entry in plans[self]:
+            data = self._serialize_planned_field(entry, record, plans, path, memo)
+            if data is not None:
+                result[entry.key] = data
+        path.discard(key)
+
+        if self.use_snippet and self.export_code:
+            ctx = self._get_eval_context()
+            ctx.update({"result": result, "record": record})
+            snippets.run(self, "export_code", ctx)
+
+        if self.use_sync_date:
+            result["sync_date"] = record.write_date.isoformat(" ")
+
+        if memo:
+            footprint, loop = memo.leave(key)
+            # Only related records are stored and never if a loop was detected
+            if path and not loop:
+                memo.put(key, result, footprint)
+                return _copy_output(result)
+
+        return result
+
+    def _serialize_planned_field(self, entry, record, plans, path, memo=None):
+        if entry.kind == "value":
+            return record[entry.fname]
+
+        if entry.kind == "date":
+            return record._fields[entry.fname].to_string(record[entry.fname])
+
+        if entry.kind == "many2one":
+            return entry.serializer._serialize_planned(
+                record[entry.fname], plans, path, memo
+            )
+
+        if entry.kind == "x2many":
+            result = []
+            for rec in record[entry.fname]:
+                data = entry.serializer._serialize_planned(rec, plans, path, memo)
+                if data:
+                    result.append(data)
+
+            if result:
+                return result
+
+            return [] if self.env.context.get("include_empty_keys") else None
+
+        raise NotImplementedError()
+
+    def serialize(self, records):
+        self.ensure_one()
+        return self._dumps(self._serialize_records(records))
+
+    def _serialize_batches(self, records, batch_size=None):
+        """Serialize the records in batches and yield the records of each batch
+        with their python objects. The values loaded for a batch are removed
+        from the cache afterwards to keep the memory bounded"""
+        self.ensure_one()
+        names = self._get_export_models() | {records._name}
+        for ids in split_every(batch_size or models.PREFETCH_MAX, records.ids):
+            batch = records.browse(ids)
+            yield batch, self._serialize_records(batch)
+
+            # Pending updates would get lost by the invalidation
+            for name in names:
+                model = self.env[name]
+                model.flush(list(model._fields))
+                if name == records._name:
+                    model.invalidate_cache(ids=batch.ids)
+                else:
+                    model.invalidate_cache()
+
+    def _get_export_models(self):
+        """Returns the models of the serializer and its related serializers"""
+        self.ensure_one()
+        result, seen, pending = set(), self.browse(), self
+        while pending:
+            seen |= pending
+            result.update(pending.mapped("model_id.model"))
+            pending = pending.mapped("field_ids.related_serializer_id") - seen
+        return result
+
+    def serialize_stream(self, records, ndjson=False, batch_size=None):
+        """Serialize the records and yield the output in chunks. The chunks form
+        the same JSON list as `serialize` or one JSON object per line if
+        `ndjson` is set"""
+        self.ensure_one()
+        first = True
+        if not ndjson:
+            yield "["
+
+        for _batch, data in self._serialize_batches(records, batch_size):
+            if ndjson:
+                yield "".join(f"{json.dumps(item)}\n" for item in data)
+                continue
+
+            if data:
+                chunk = ", ".join(map(json.dumps, data))
+                yield chunk if first else f", {chunk}"
+                first = False
+
+        if not ndjson:
+            yield "]"
 
     def _serialize(self, record, visited=None):
         self.ensure_one()
@@ -371,27 +816,31 @@ class Serializer(models.Model):
             return {} if self.env.context.get("include_empty_keys") else None
 
         record.ensure_one()
-        if not visited:
-            visited = []
-
-        if (record, self) in visited:
+        # The records and serializers of the parent levels to detect loops
+        if visited is None:
+            visited = set()
+        elif not isinstance(visited, set):
+            visited = set(visited)
+
+        key = (record, self)
+        if key in visited:
             if self.env.context.get("raise_on_duplicate"):
                 raise UserError(_("Loop detected"))
             return {} if self.env.context.get("include_empty_keys") else None
 
-        visited.append((record, self))
-
+        visited.add(key)
         result = {}
         for field in self.field_ids.filtered("exporting"):
             fname = field.name or field.field_id.name
-            data = field._serialize(record, visited[:])
+            data = field._serialize(record, visited)
             if data is not None:
-                result[fname] = field._serialize(record, visited[:])
+                result[fname] = data
+        visited.discard(key)
 
         if self.use_snippet and self.export_code:
             ctx = self._get_eval_context()
             ctx.update({"result": result, "record": record})
-            safe_eval.safe_eval(self.export_code, ctx, mode="exec", nocopy=True)
+            snippets.run(self, "export_code", ctx)
 
         if self.use_sync_date:
             result["sync_date"] = record.write_date.isoformat(" ")
@@ -2,11 +2,15 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import json
+from unittest.mock import patch
 
 from odoo.exceptions import UserError, ValidationError
 from odoo.fields import Command, Datetime
 from odoo.tests import TransactionCase
 
+from ..models.serializer import Serializer, SerializerField
+from ..snippet import snippets
+
 
 class TestSerializer(TransactionCase):
     def setUp(self):
@@ -214,6 +218,129 @@ class TestSerializer(TransactionCase):
             ],
         )
 
+    def test_serialize_batch(self):
+        child = self.serializer.copy(
+            {"name": "Child Serializer", "use_sync_date": False}
+        )
+        child.field_ids = [self._create_field("name"), self._create_field("ref")]
+        self.serializer.write(
+            {
+                "raise_on_duplicate": False,
+                "use_snippet": True,
+                "export_code": "result['key'] = record.ref",
+                "field_ids": [
+                    self._create_field("name"),
+                    self._create_field("write_date"),
+                    self._create_field("parent_id", "parent", self.serializer.id),
+                    self._create_field("child_ids", "childs", self.serializer.id),
+                    self._create_field("bank_ids", "banks", child.id),
+                ],
+            }
+        )
+
+        records = self.parent | self.partner | self.partner.child_ids
+        for include_empty_keys in (False, True):
+            self.serializer.include_empty_keys = include_empty_keys
+            serializer = self.serializer.with_context(
+                include_empty_keys=include_empty_keys, raise_on_duplicate=False
+            )
+            self.assertEqual(
+                self.serializer._serialize_records(records),
+                [serializer._serialize(rec) for rec in records],
+            )
+
+        # The batched serialization doesn't need more queries
+        counts = []
+        for func in (
+            self.serializer._serialize_records,
+            lambda recs: [serializer._serialize(rec) for rec in recs],
+        ):
+            records.invalidate_cache()
+            before = self.env.cr.sql_log_count
+            func(records)
+            counts.append(self.env.cr.sql_log_count - before)
+        self.assertLessEqual(*counts)
+
+    def test_serialize_memo(self):
+        parent = self.serializer.copy({"name": "Parent Serializer"})
+        parent.field_ids = [self._create_field("name"), self._create_field("ref")]
+        self.serializer.write(
+            {
+                "raise_on_duplicate": False,
+                "field_ids": [
+                    self._create_field("name"),
+                    self._create_field("parent_id", "parent", parent.id),
+                    self._create_field("child_ids", "childs", self.serializer.id),
+                ],
+            }
+        )
+        records = self.partner.child_ids | self.partner | self.parent
+        legacy = [
+            self.serializer.with_context(raise_on_duplicate=False)._serialize(rec)
+            for rec in records
+        ]
+
+        def count_fields(cache_size):
+            self.serializer.cache_size = cache_size
+            with patch.object(
+                Serializer,
+                "_serialize_planned_field",
+                autospec=True,
+                side_effect=Serializer._serialize_planned_field,
+            ) as mock:
+                self.assertEqual(self.serializer._serialize_records(records), legacy)
+            return mock.call_count
+
+        # The shared parent is serialized only once
+        self.assertLess(count_fields(1000), count_fields(0))
+
+        # Reused outputs are copies
+        data = self.serializer._serialize_records(self.partner.child_ids)
+        self.assertEqual(data[0]["parent"], data[1]["parent"])
+        self.assertIsNot(data[0]["parent"], data[1]["parent"])
+
+    def test_serialize_batches_cache(self):
+        self.serializer.write(
+            {"use_sync_date": False, "field_ids": [self._create_field("name")]}
+        )
+        records = self.parent | self.partner
+        user = self.env.user
+        self.assertTrue(user.login)
+
+        # Only the values of the serialized batches are removed from the cache
+        batches = list(self.serializer._serialize_batches(records, batch_size=1))
+        self.assertEqual(len(batches), 2)
+        self.assertTrue(self.env.cache.contains(user, user._fields["login"]))
+        for rec in records:
+            self.assertFalse(self.env.cache.contains(rec, rec._fields["name"]))
+
+    def test_serialize_stream(self):
+        self.serializer.write(
+            {
+                "use_sync_date": False,
+                "field_ids": [self._create_field("name"), self._create_field("ref")],
+            }
+        )
+        records = self.parent | self.partner | self.partner.child_ids
+
+        chunks = list(self.serializer.serialize_stream(records, batch_size=3))
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual("".join(chunks), self.serializer.serialize(records))
+
+        empty = records.browse()
+        self.assertEqual(
+            "".join(self.serializer.serialize_stream(empty)),
+            self.serializer.serialize(empty),
+        )
+
+        lines = "".join(
+            self.serializer.serialize_stream(records, ndjson=True, batch_size=2)
+        ).splitlines()
+        self.assertEqual(
+            list(map(json.loads, lines)),
+            json.loads(self.serializer.serialize(records)),
+        )
+
     def test_serialize_snippet(self):
         self.serializer.write(
             {
@@ -232,6 +359,15 @@ class TestSerializer(TransactionCase):
             },
         )
 
+    def test_snippet_cache(self):
+        self.serializer.write({"use_snippet": True, "export_code": "result['a'] = 1"})
+        compiled = snippets.compile(self.serializer, "export_code")
+        self.assertEqual(self.serializer._serialize(self.partner)["a"], 1)
+        self.assertIs(compiled, snippets.compile(self.serializer, "export_code"))
+
+        self.serializer.export_code = "result['a'] = 2"
+        self.assertEqual(self.serializer._serialize(self.partner)["a"], 2)
+
     def test_deserialize_json(self):
         self.serializer.field_ids = [
             self._create_field("name"),
@@ -297,6 +433,28 @@ class TestSerializer(TransactionCase):
             },
         )
 
+    def test_import_plan(self):
+        self.serializer.field_ids = [
+            self._create_field("name", "title"),
+            self._create_field("ref"),
+        ]
+        by_key, by_fname = self.serializer._get_import_plan()
+        self.assertEqual(set(by_key), {"title", "ref"})
+        self.assertEqual(set(by_fname), {"name", "ref"})
+        self.assertIs(by_key, self.serializer._get_import_plan()[0])
+
+        # Fields outside of the plan keep it cached
+        title = self.serializer.field_ids.filtered(lambda f: f.name == "title")
+        title.exporting = False
+        self.assertIs(by_key, self.serializer._get_import_plan()[0])
+
+        title.write({"exporting": True, "importing": False})
+        self.assertEqual(set(self.serializer._get_import_plan()[0]), {"ref"})
+        self.assertEqual(
+            self.serializer._deserialize({"title": "abc", "ref": "cba"}),
+            {"ref": "cba"},
+        )
+
     def test_deserialize_type_error(self):
         with self.assertRaises(UserError):
             self.serializer._deserialize([])
@@ -385,6 +543,65 @@ class TestSerializer(TransactionCase):
         with self.assertRaises(UserError):
             self.serializer._import_deserialized([])
 
+    def test_importing_bulk(self):
+        self.serializer.write(
+            {
+                "import_domain": "[('ref', '=', ref)]",
+                "use_sync_date": False,
+                "field_ids": [self._create_field("name"), self._create_field("ref")],
+            }
+        )
+        key = self.serializer._get_import_key([("ref", "=", "a")])
+        self.assertEqual(key, (("ref", "a"),))
+        self.assertIsNone(self.serializer._get_import_key([("ref", "ilike", "a")]))
+        self.assertIsNone(self.serializer._get_import_key(["|", ("ref", "=", "a")]))
+        self.assertIsNone(self.serializer._get_import_key([("ref", "=", False)]))
+        self.assertIsNone(self.serializer._get_import_key([("color", "=", 0)]))
+
+        rows = [{"name": f"Bulk {i}", "ref": f"bulk-{i}"} for i in range(20)]
+        rows += [
+            {"name": "Updated", "ref": self.partner.ref},
+            # Created by a previous row of the same import
+            {"name": "Bulk again", "ref": "bulk-0"},
+        ]
+        records = self.serializer.import_deserialized(rows)
+        self.assertEqual(len(records), 21)
+        self.assertIn(self.partner, records)
+        self.assertEqual(self.partner.name, "Updated")
+
+        partners = self.env["res.partner"].search([("ref", "=like", "bulk-%")])
+        self.assertEqual(len(partners), 20)
+        self.assertEqual(
+            partners.filtered(lambda p: p.ref == "bulk-0").name, "Bulk again"
+        )
+
+        # Rows without match aren't created
+        records = self.serializer.import_deserialized(
+            [{"name": "Missing", "ref": "missing"}], create=False
+        )
+        self.assertFalse(records)
+
+        # Domains which can't be batched are imported per row
+        self.serializer.import_domain = "[('ref', '=ilike', ref)]"
+        records = self.serializer.import_deserialized(
+            [{"name": "Case", "ref": self.partner.ref.upper()}]
+        )
+        self.assertEqual(records, self.partner)
+
+        # Falsy keys are matched per row
+        self.serializer.write(
+            {
+                "import_domain": "[('ref', '=', ref), ('color', '=', color)]",
+                "field_ids": [self._create_field("color")],
+            }
+        )
+        self.partner.color = 0
+        records = self.serializer.import_deserialized(
+            [{"name": "Zero", "ref": self.partner.ref, "color": 0}]
+        )
+        self.assertEqual(records, self.partner)
+        self.assertEqual(self.partner.name, "Zero")
+
     def test_preview(self):
         self.serializer.field_ids = [
             self._create_field("name"),
@@ -429,3 +646,35 @@ class TestSerializer(TransactionCase):
         preview.write({"serialized": False, "deserialized": "test"})
         preview._onchange_deserialized()
         self.assertEqual(preview.deserialized, "test")
+
+    def test_serialize_scaling(self):
+        self.serializer.write(
+            {
+                "use_sync_date": False,
+                "field_ids": [
+                    self._create_field("name"),
+                    self._create_field("parent_id", "parent", self.serializer.id),
+                ],
+            }
+        )
+
+        partner = self.env["res.partner"]
+        for i in range(20):
+            partner = partner.create({"name": f"Level {i}", "parent_id": partner.id})
+        chain = [partner]
+        while chain[-1].parent_id:
+            chain.append(chain[-1].parent_id)
+
+        def count_calls(record):
+            with patch.object(
+                SerializerField,
+                "_serialize",
+                autospec=True,
+                side_effect=SerializerField._serialize,
+            ) as mock:
+                self.serializer._serialize(record)
+            return mock.call_count
+
+        # Every field is serialized once per level
+        self.assertEqual(count_calls(chain[10]), 20)
+        self.assertEqual(count_calls(chain[0]), 40)